@@ -0,0 +1,247 @@
+"""
+Benchmark the PARSING_PDF strategies over data/sample_forms and a synthetic scaled-up corpus.
+
+Each strategy runs in a fresh process so peak RSS is measured per strategy; pdfium's
+page-range worker processes are reported separately as peak_worker_rss_mb.
+Reports pages/sec, peak RSS, extracted characters and how often is_text_poor fires,
+writes machine-readable JSON, and flags regressions against a stored baseline.
+pages/sec is only compared when the baseline was recorded with the same Python
+version and CPU count.
+
+Usage (from src/backend):
+    python benchmarks/parser_benchmark.py
+    python benchmarks/parser_benchmark.py --scale 50 --repeat 5
+    python benchmarks/parser_benchmark.py --update-baseline
+"""
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(os.path.dirname(BACKEND_DIR))
+SAMPLE_FORMS_DIR = os.path.join(REPO_ROOT, "data", "sample_forms")
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, "benchmarks", "parser_baseline.json")
+
+MIN_TIMED_SECONDS = 0.1
+
+STRATEGIES = ["PyPDFLoader", "PyMuPDFLoader", "PDFMinerLoader", "pdfium", "docling"]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _worker_peak_rss_mb(pids: list[int]) -> float:
+    """
+    Largest peak RSS (VmHWM) among the given live worker processes; 0 without /proc.
+    ru_maxrss of reaped children is not used: on Linux it keeps the parent's RSS from
+    before the worker's exec.
+    """
+    peaks = []
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                peaks.extend(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+        except OSError:
+            continue
+    return round(max(peaks) / 1024, 1) if peaks else 0.0
+
+
+def _as_documents(result):
+    from langchain_core.documents import Document
+    if isinstance(result, list):
+        return result
+    if hasattr(result, "export_to_markdown"):
+        # docling returns a DoclingDocument
+        return [Document(page_content=result.export_to_markdown(), metadata={})]
+    raise TypeError(f"Unexpected parser output: {type(result).__name__}")
+
+
+def run_strategy(args) -> dict:
+    """
+    Parse every file with one strategy, keeping the best of `repeat` runs. Runs in a child process.
+    """
+    strategy, pdf_paths, repeat = args
+    sys.path.insert(0, BACKEND_DIR)
+    # Parsing never calls OpenAI, but importing parsing_utils builds a client
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("VISION_CACHE_PATH", os.path.join(tempfile.gettempdir(), "benchmark_vision_cache.db"))
+    import fitz
+    from parsing_utils import PARSING_PDF, is_text_poor, MIN_PAGE_TEXT_CHARS
+
+    pages = 0
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as doc:
+            pages += len(doc)
+
+    rss_before = _peak_rss_mb()
+    best_seconds = None
+    try:
+        for _ in range(repeat):
+            docs_per_file = []
+            start = time.perf_counter()
+            for pdf_path in pdf_paths:
+                docs_per_file.append(_as_documents(PARSING_PDF(strategy, pdf_path)))
+            elapsed = time.perf_counter() - start
+            best_seconds = elapsed if best_seconds is None else min(best_seconds, elapsed)
+    except Exception as e:
+        return {"strategy": strategy, "error": f"{type(e).__name__}: {e}"}
+
+    all_docs = [d for docs in docs_per_file for d in docs]
+    return {
+        "strategy": strategy,
+        "files": len(pdf_paths),
+        "pages": pages,
+        "seconds": round(best_seconds, 4),
+        "pages_per_sec": round(pages / best_seconds, 2) if best_seconds else None,
+        "chars": sum(len(d.page_content) for d in all_docs),
+        "text_poor_files": sum(1 for docs in docs_per_file if is_text_poor(docs)),
+        "text_poor_pages": sum(1 for d in all_docs if is_text_poor([d], min_chars=MIN_PAGE_TEXT_CHARS)),
+        "rss_after_import_mb": rss_before,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_strategy_into_queue(queue, args):
+    result = run_strategy(args)
+    from parsing_utils import shutdown_pdf_process_pool, pdf_process_pool_pids
+    if "error" not in result:
+        result["peak_worker_rss_mb"] = _worker_peak_rss_mb(pdf_process_pool_pids())
+    # pdfium's page-range process pool would otherwise keep this process from exiting
+    shutdown_pdf_process_pool()
+    queue.put(result)
+
+
+def build_scaled_corpus(pdf_paths: list[str], scale: int, out_dir: str) -> list[str]:
+    """
+    Concatenate the sample forms `scale` times into one large PDF.
+    """
+    import fitz
+    out_path = os.path.join(out_dir, f"synthetic_x{scale}.pdf")
+    with fitz.open() as combined:
+        for _ in range(scale):
+            for pdf_path in pdf_paths:
+                with fitz.open(pdf_path) as src:
+                    combined.insert_pdf(src)
+        combined.save(out_path)
+    return [out_path]
+
+
+def run_corpus(name: str, pdf_paths: list[str], strategies: list[str], repeat: int) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for strategy in strategies:
+        # A fresh process per strategy keeps peak RSS numbers independent.
+        # Not a pool worker: those are daemonic and pdfium may start its own process pool.
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_strategy_into_queue, args=(queue, (strategy, pdf_paths, repeat)))
+        process.start()
+        result = queue.get()
+        process.join()
+        results[strategy] = result
+        print(f"[{name}] {strategy}: " + (result.get("error") or
+              f"{result['pages_per_sec']} pages/sec, {result['peak_rss_mb']} MB peak "
+              f"({result['peak_worker_rss_mb']} MB in worker processes), "
+              f"{result['chars']} chars, text-poor pages {result['text_poor_pages']}/{result['pages']}"),
+              file=sys.stderr)
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float, compare_throughput: bool = True) -> list[str]:
+    regressions = []
+    for corpus, strategies in results["corpora"].items():
+        for strategy, current in strategies.items():
+            previous = baseline.get("corpora", {}).get(corpus, {}).get(strategy)
+            if not previous or "error" in previous:
+                continue
+            label = f"{corpus}/{strategy}"
+            if "error" in current:
+                regressions.append(f"{label}: now fails ({current['error']})")
+                continue
+            # Runs of a few milliseconds are too noisy to compare throughput
+            if (compare_throughput and previous["seconds"] >= MIN_TIMED_SECONDS
+                    and current["pages_per_sec"] < previous["pages_per_sec"] * (1 - tolerance)):
+                regressions.append(f"{label}: pages/sec {previous['pages_per_sec']} -> {current['pages_per_sec']}")
+            if current["peak_rss_mb"] > previous["peak_rss_mb"] * (1 + tolerance):
+                regressions.append(f"{label}: peak RSS {previous['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+            if ("peak_worker_rss_mb" in previous
+                    and current["peak_worker_rss_mb"] > previous["peak_worker_rss_mb"] * (1 + tolerance)):
+                regressions.append(f"{label}: worker peak RSS {previous['peak_worker_rss_mb']} -> "
+                                   f"{current['peak_worker_rss_mb']} MB")
+            if current["chars"] != previous["chars"]:
+                regressions.append(f"{label}: extracted chars {previous['chars']} -> {current['chars']}")
+            if current["text_poor_pages"] != previous["text_poor_pages"]:
+                regressions.append(f"{label}: text-poor pages {previous['text_poor_pages']} -> {current['text_poor_pages']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--forms-dir", default=SAMPLE_FORMS_DIR)
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES)
+    parser.add_argument("--scale", type=int, default=25, help="copies of the sample forms in the synthetic corpus (0 to skip)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per strategy; the fastest is kept")
+    parser.add_argument("--output", default="parser_benchmark_results.json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown / RSS growth")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    pdf_paths = sorted(glob.glob(os.path.join(args.forms_dir, "*.pdf")))
+    if not pdf_paths:
+        sys.exit(f"No PDFs found in {args.forms_dir}")
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "scale": args.scale,
+        "corpora": {"sample_forms": run_corpus("sample_forms", pdf_paths, args.strategies, args.repeat)},
+    }
+    if args.scale > 0:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scaled = build_scaled_corpus(pdf_paths, args.scale, tmp_dir)
+            results["corpora"][f"synthetic_x{args.scale}"] = run_corpus(
+                f"synthetic_x{args.scale}", scaled, args.strategies, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline updated: {args.baseline}", file=sys.stderr)
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --update-baseline to store one.", file=sys.stderr)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # Throughput depends on the machine; only compare it against a baseline from a like one
+    mismatched = [f"{key} {baseline.get(key)} -> {results[key]}" for key in ("python", "cpu_count")
+                  if baseline.get(key) != results[key]]
+    if mismatched:
+        print(f"WARNING baseline was recorded on a different setup ({', '.join(mismatched)}); "
+              f"pages/sec is not compared. Run with --update-baseline on this machine to compare it.", file=sys.stderr)
+    regressions = find_regressions(results, baseline, args.tolerance, compare_throughput=not mismatched)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+    print("No regressions against baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
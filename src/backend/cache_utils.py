@@ -0,0 +1,374 @@
+import sqlite3
+import threading
+import time
+import hashlib
+import json
+from array import array
+from collections import OrderedDict
+import numpy as np
+from typing import Callable, Optional
+from langchain_core.embeddings import Embeddings
+
+
+def sha256_hex(data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class SQLiteLRUCache:
+    """
+    Disk-backed key/value cache with size-bounded LRU eviction.
+    Values are stored as bytes; callers do their own serialization.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        conn = self._connect()
+        conn.execute('''CREATE TABLE IF NOT EXISTS cache_entries
+                        (key TEXT PRIMARY KEY,
+                         value BLOB,
+                         size INTEGER,
+                         last_access REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_last_access ON cache_entries (last_access)')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict:
+        """
+        Returns {key: value} for the keys that are cached and refreshes their LRU position.
+        """
+        found = {}
+        if not keys:
+            return found
+
+        with self._lock:
+            conn = self._connect()
+            # Stay well under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f'SELECT key, value FROM cache_entries WHERE key IN ({placeholders})', batch)
+                found.update({key: value for key, value in rows})
+
+            if found:
+                now = time.time()
+                conn.executemany('UPDATE cache_entries SET last_access = ? WHERE key = ?',
+                                 [(now, key) for key in found])
+                conn.commit()
+            conn.close()
+
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put(self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    def put_many(self, items: dict):
+        if not items:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.executemany('INSERT OR REPLACE INTO cache_entries (key, value, size, last_access) VALUES (?, ?, ?, ?)',
+                             [(key, value, len(value), now) for key, value in items.items()])
+            self._evict(conn)
+            conn.commit()
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Evict least recently used entries until we are back under the budget
+        to_delete = []
+        for key, size in conn.execute('SELECT key, size FROM cache_entries ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM cache_entries WHERE key = ?', to_delete)
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries').fetchone()
+        conn.close()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size,
+                "max_bytes": self.max_bytes}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model with a persistent cache keyed by (model, text hash).
+    Only texts that miss the cache are sent to the underlying model.
+    """
+
+    def __init__(self, underlying: Embeddings, cache: SQLiteLRUCache, model_name: str = None):
+        self.underlying = underlying
+        self.cache = cache
+        self.model_name = model_name or getattr(underlying, "model", type(underlying).__name__)
+        self.api_calls = 0
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}:{sha256_hex(text)}"
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Embed each distinct missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            self.api_calls += 1
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new_entries = {key: array("f", vector).tobytes() for key, vector in zip(missing, vectors)}
+            self.cache.put_many(new_entries)
+            cached.update(new_entries)
+
+        return [array("f", cached[key]).tolist() for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return array("f", cached).tolist()
+
+        self.api_calls += 1
+        vector = self.underlying.embed_query(text)
+        self.cache.put(key, array("f", vector).tobytes())
+        return vector
+
+    def stats(self) -> dict:
+        return {"model": self.model_name, "api_calls": self.api_calls, **self.cache.stats()}
+
+
+class FileVectorCache:
+    """
+    In-memory per-file copy of chunk vectors for brute-force search.
+    Each file is one contiguous float32 matrix of L2-normalized rows, so cosine
+    similarity is a single matrix product. Files are evicted LRU by total matrix size.
+    Each file has a generation, bumped by invalidate; a put for an older generation is
+    not cached, so vectors fetched while the file was being rewritten never stick.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # file_id -> (matrix, documents)
+        self._generations = {}  # file_id -> number of invalidations
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        """
+        Returns (matrix, documents) for a cached file, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+            return entry
+
+    def generation(self, file_id) -> int:
+        """
+        Capture before fetching a file's vectors and pass to put.
+        """
+        with self._lock:
+            return self._generations.get(file_id, 0)
+
+    def put(self, file_id, vectors, documents: list, generation: int = None):
+        """
+        Returns the entry; it is only cached if the file was not invalidated since generation.
+        """
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not documents:
+            matrix = matrix.reshape(0, 0)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        entry = (matrix, documents)
+        if matrix.nbytes > self.max_bytes:
+            return entry
+
+        with self._lock:
+            if generation is not None and generation != self._generations.get(file_id, 0):
+                return entry
+            self._discard(file_id)
+            self._entries[file_id] = entry
+            self._bytes += matrix.nbytes
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return entry
+
+    def invalidate(self, file_id):
+        with self._lock:
+            self._generations[file_id] = self._generations.get(file_id, 0) + 1
+            self._discard(file_id)
+
+    def _discard(self, file_id):
+        entry = self._entries.pop(file_id, None)
+        if entry is not None:
+            self._bytes -= entry[0].nbytes
+
+    @staticmethod
+    def search(entry, query_vectors, k: int) -> list:
+        """
+        Returns, for each query vector, the top-k documents of the entry by cosine similarity.
+        """
+        matrix, documents = entry
+        if not documents:
+            return [[] for _ in query_vectors]
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries /= np.where(norms == 0, 1, norms)
+        scores = queries @ matrix.T
+
+        k = min(k, len(documents))
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            results.append([documents[i] for i in top[np.argsort(-row[top])]])
+        return results
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "files": len(self._entries), "bytes": self._bytes,
+                "max_bytes": self.max_bytes}
+
+
+class SemanticAnswerCache:
+    """
+    Cache of chat answers keyed by (model, corpus version), matched on the standalone
+    question: an exact match first, otherwise the most similar cached question by
+    embedding cosine similarity, if it clears min_similarity and identifiers(question)
+    (e.g. its policy IDs, phone numbers and dates) is the same for both questions.
+    Entries from other corpus versions are never returned and are dropped on the next store.
+    """
+
+    def __init__(self, path: str, max_entries: int, min_similarity: float,
+                 identifiers: Callable[[str], frozenset] = lambda question: frozenset()):
+        self.path = path
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.identifiers = identifiers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        conn = self._connect()
+        conn.execute('''CREATE TABLE IF NOT EXISTS answer_cache
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         model TEXT,
+                         corpus_version INTEGER,
+                         question TEXT,
+                         normalized_question TEXT,
+                         embedding BLOB,
+                         answer TEXT,
+                         sources TEXT,
+                         created_at REAL,
+                         last_hit REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_answer_cache_model_version ON answer_cache (model, corpus_version)')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _normalize(question: str) -> str:
+        return " ".join(question.casefold().split())
+
+    def lookup(self, model: str, corpus_version: int, question: str, embed: Optional[Callable[[], list]] = None):
+        """
+        Returns {"answer", "sources", "matched_question", "similarity", "cached_at"} or None.
+        embed returns the question's embedding; it is only called when there is no exact
+        match but some cached question has the same identifiers. Without it only exact
+        matches are accepted.
+        """
+        conn = self._connect()
+        rows = conn.execute('SELECT id, normalized_question, embedding FROM answer_cache WHERE model = ? AND corpus_version = ?',
+                            (model, corpus_version)).fetchall()
+        best_id, best_similarity = None, None
+        normalized = self._normalize(question)
+        for entry_id, entry_question, _ in rows:
+            if entry_question == normalized:
+                best_id, best_similarity = entry_id, 1.0
+                break
+        if best_id is None and embed is not None:
+            # Questions about different IDs embed almost identically, so they must never match
+            identifiers = self.identifiers(question)
+            candidates = [row for row in rows if row[2] is not None and self.identifiers(row[1]) == identifiers]
+            if candidates:
+                matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, _, blob in candidates])
+                query = np.asarray(embed(), dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1)
+                similarities = matrix @ query / np.where(norms == 0, 1, norms)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.min_similarity:
+                    best_id, best_similarity = candidates[best][0], float(similarities[best])
+
+        if best_id is None:
+            conn.close()
+            self.misses += 1
+            return None
+
+        question, answer, sources, created_at = conn.execute(
+            'SELECT question, answer, sources, created_at FROM answer_cache WHERE id = ?', (best_id,)).fetchone()
+        conn.execute('UPDATE answer_cache SET last_hit = ? WHERE id = ?', (time.time(), best_id))
+        conn.commit()
+        conn.close()
+        self.hits += 1
+        return {
+            "answer": answer,
+            "sources": json.loads(sources),
+            "matched_question": question,
+            "similarity": round(best_similarity, 4),
+            "cached_at": created_at,
+        }
+
+    def store(self, model: str, corpus_version: int, question: str, embedding: Optional[list], answer: str, sources: list):
+        """
+        Entries stored without an embedding are only ever matched exactly.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('''INSERT INTO answer_cache (model, corpus_version, question, normalized_question, embedding,
+                                                      answer, sources, created_at, last_hit)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (model, corpus_version, question, self._normalize(question),
+                          None if embedding is None else np.asarray(embedding, dtype=np.float32).tobytes(), answer, json.dumps(sources), now, now))
+            # Answers for older corpus versions can never be returned again
+            conn.execute('DELETE FROM answer_cache WHERE corpus_version < ?', (corpus_version,))
+            conn.execute('''DELETE FROM answer_cache WHERE id NOT IN
+                            (SELECT id FROM answer_cache ORDER BY last_hit DESC LIMIT ?)''', (self.max_entries,))
+            conn.commit()
+            conn.close()
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        entries = conn.execute('SELECT COUNT(*) FROM answer_cache').fetchone()[0]
+        conn.close()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "max_entries": self.max_entries,
+                "min_similarity": self.min_similarity}
@@ -0,0 +1,40 @@
+import os
+import hashlib
+from typing import Dict, List, Optional
+
+CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY", "./chroma_db")
+# langchain_chroma's default collection name, used as is by the unsharded layout
+CHROMA_COLLECTION = "langchain"
+# Number of hash partitions of the chunk collection; 1 keeps the single-collection layout
+CHROMA_SHARDS = int(os.getenv("CHROMA_SHARDS", "1"))
+
+
+def shard_collection_name(shard: int, num_shards: int = CHROMA_SHARDS) -> str:
+    """
+    Collection holding one shard. The shard count is part of the name, so layouts with
+    different shard counts never share a collection.
+    """
+    if num_shards == 1:
+        return CHROMA_COLLECTION
+    return f"{CHROMA_COLLECTION}_shard_{shard:03d}_of_{num_shards:03d}"
+
+
+def shard_for(file_id, num_shards: int = CHROMA_SHARDS) -> int:
+    """
+    Shard holding every chunk of a file. All chunks of one file live in the same shard.
+    """
+    if num_shards == 1:
+        return 0
+    return int(hashlib.sha256(str(file_id).encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+
+def group_by_shard(file_ids: Optional[List[int]], num_shards: int = CHROMA_SHARDS) -> Dict[int, Optional[List[int]]]:
+    """
+    {shard: file_ids in that shard}. None means every file, so every shard is searched unfiltered.
+    """
+    if file_ids is None:
+        return {shard: None for shard in range(num_shards)}
+    groups = {}
+    for file_id in file_ids:
+        groups.setdefault(shard_for(file_id, num_shards), []).append(file_id)
+    return groups
@@ -2,12 +2,169 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_text_splitters import TokenTextSplitter
 from langchain_experimental.text_splitter import SemanticChunker
+from langchain_text_splitters import TextSplitter
 from langchain_openai.embeddings import OpenAIEmbeddings
+import numpy as np
+import re
 
 
+PAGE_MARKER = re.compile(r"^-{2,}\s*Page\s+\S+\s*-{2,}$", re.IGNORECASE)
+# "field: value", or "field:" for a blank field (json_to_retrieval_text writes "Middle Name: ")
+FIELD_LINE = re.compile(r"^[^:]{1,80}:")
+# Tokens such as "123-45-6789" or "AB-1234"; an all-caps line holding one is data, not a heading
+IDENTIFIER_TOKEN = re.compile(r"\S*\d\S*")
 
 
-def CHUNKING_STRATEGY(chunking_strategy):
+class FormStructureSplitter(TextSplitter):
+    """
+    Splits form text on page and section boundaries and packs whole sections into chunks.
+    A line (e.g. a `field: value` pair from json_to_retrieval_text) is never cut, and there
+    is no overlap; when a section has to be split, its heading is repeated on each part.
+    """
+
+    def __init__(self, chunk_size: int = 1500, **kwargs):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=0, **kwargs)
+        self._line_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+
+    @staticmethod
+    def _is_heading(line: str) -> bool:
+        """
+        Page markers, markdown headings and short all-caps lines. A line with a colon is a
+        field (possibly blank), and an all-caps line with an identifier in it is a value.
+        """
+        stripped = line.strip()
+        if PAGE_MARKER.match(stripped) or stripped.startswith("#"):
+            return True
+        if FIELD_LINE.match(stripped):
+            return False
+        return (stripped.isupper() and len(stripped) <= 60
+                and not any(len(token) > 3 for token in IDENTIFIER_TOKEN.findall(stripped)))
+
+    def _sections(self, text: str) -> list[list[str]]:
+        sections, current = [], []
+        for line in text.split("\n"):
+            line = line.rstrip()
+            if not line.strip():
+                if current:
+                    sections.append(current)
+                    current = []
+                continue
+            if current and self._is_heading(line):
+                sections.append(current)
+                current = []
+            current.append(line)
+        if current:
+            sections.append(current)
+        return sections
+
+    def _split_long_section(self, section: list[str], lead: str = None) -> list[str]:
+        """
+        Pack the lines of a section that does not fit in one chunk.
+        lead is pending text from earlier sections that the first part may start with.
+        """
+        heading = section[0] if self._is_heading(section[0]) else None
+        chunks, current, size = [], [], 0
+        if lead:
+            # The lead's chunk must fit the heading together with the first body line,
+            # otherwise the heading would end it alone and be repeated on the next chunk
+            opening = section[:2] if heading else section[:1]
+            if len(lead) + 2 + sum(len(line) + 1 for line in opening) > self._chunk_size:
+                chunks.append(lead)
+            else:
+                current, size = [lead + "\n"], len(lead) + 2
+        for line in section:
+            if len(line) > self._chunk_size:
+                # Only a single over-long line is ever cut
+                if current:
+                    chunks.append("\n".join(current))
+                    current, size = [], 0
+                chunks.extend(self._line_splitter.split_text(line))
+                continue
+            if current and size + len(line) + 1 > self._chunk_size:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+                if heading and len(heading) + len(line) + 1 <= self._chunk_size:
+                    current, size = [heading], len(heading) + 1
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def split_text(self, text: str) -> list[str]:
+        chunks, current, size = [], [], 0
+        for section in self._sections(text):
+            section_text = "\n".join(section)
+            if len(section_text) > self._chunk_size:
+                chunks.extend(self._split_long_section(section, lead="\n\n".join(current)))
+                current, size = [], 0
+                continue
+            if current and size + len(section_text) + 2 > self._chunk_size:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(section_text)
+            size += len(section_text) + 2
+        if current:
+            chunks.append("\n\n".join(current))
+        return chunks
+
+
+class SentenceVectorSemanticChunker(SemanticChunker):
+    """
+    SemanticChunker that reuses the sentence embeddings it computes for breakpoints.
+    Each chunk's vector is the normalized mean of its sentence vectors. They are kept in
+    chunk_vectors (chunk text -> vector) for indexing only, never in the embedding cache,
+    since they are approximations of what the model would return for the chunk text.
+    """
+
+    def __init__(self, embeddings, **kwargs):
+        super().__init__(embeddings, **kwargs)
+        self.chunk_vectors = {}
+
+    def split_text(self, text: str) -> list[str]:
+        single_sentences_list = re.split(self.sentence_split_regex, text)
+        # Too few sentences for breakpoints; nothing was embedded, so nothing to reuse
+        if len(single_sentences_list) == 1:
+            return single_sentences_list
+        if self.breakpoint_threshold_type == "gradient" and len(single_sentences_list) == 2:
+            return single_sentences_list
+
+        distances, sentences = self._calculate_sentence_distances(single_sentences_list)
+        if self.number_of_chunks is not None:
+            breakpoint_distance_threshold = self._threshold_from_clusters(distances)
+            breakpoint_array = distances
+        else:
+            breakpoint_distance_threshold, breakpoint_array = self._calculate_breakpoint_threshold(distances)
+
+        indices_above_thresh = [i for i, x in enumerate(breakpoint_array) if x > breakpoint_distance_threshold]
+
+        groups = []
+        start_index = 0
+        for index in indices_above_thresh:
+            group = sentences[start_index:index + 1]
+            # Same small-chunk merging as SemanticChunker
+            if self.min_chunk_size is not None and len(" ".join(d["sentence"] for d in group)) < self.min_chunk_size:
+                continue
+            groups.append(group)
+            start_index = index + 1
+        if start_index < len(sentences):
+            groups.append(sentences[start_index:])
+
+        chunks, vectors = [], []
+        for group in groups:
+            chunks.append(" ".join(d["sentence"] for d in group))
+            mean = np.mean([d["combined_sentence_embedding"] for d in group], axis=0)
+            vectors.append((mean / (np.linalg.norm(mean) or 1.0)).tolist())
+
+        self.chunk_vectors.update(zip(chunks, vectors))
+        return chunks
+
+
+def CHUNKING_STRATEGY(chunking_strategy, embeddings=None):
+    """
+    Build a text splitter. embeddings is used by the semantic strategy, whose splitter
+    also exposes chunk_vectors derived from its sentence embeddings.
+    """
     if chunking_strategy=="CharacterTextSplitter":
         text_splitter = CharacterTextSplitter(chunk_size = 1024, chunk_overlap=200, separator='', strip_whitespace=False)
     elif chunking_strategy=="RecursiveCharacterTextSplitter":
@@ -36,10 +193,11 @@ def CHUNKING_STRATEGY(chunking_strategy):
     elif chunking_strategy=="semantic":
         print("semantic")
         # Percentile - all differences between sentences are calculated, and then any difference greater than the X percentile is split
-        text_splitter = SemanticChunker(OpenAIEmbeddings())
-        text_splitter = SemanticChunker(
-        OpenAIEmbeddings(), breakpoint_threshold_type="percentile" # "standard_deviation", "interquartile"
-    )
+        text_splitter = SentenceVectorSemanticChunker(
+            embeddings or OpenAIEmbeddings(), breakpoint_threshold_type="percentile" # "standard_deviation", "interquartile"
+        )
+    elif chunking_strategy=="form":
+        text_splitter = FormStructureSplitter(chunk_size=1500)
     else:
         raise ValueError(f"Unknown chunking strategy: {chunking_strategy}")
         
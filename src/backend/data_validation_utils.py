@@ -18,6 +18,7 @@ class QueryResponse(BaseModel):
     session_id: str
     model: ModelName
     sources: List[dict] = []
+    cache: Optional[dict] = None
 
 class DocumentInfo(BaseModel):
     id: int
@@ -25,4 +26,19 @@ class DocumentInfo(BaseModel):
     upload_timestamp: datetime
 
 class DeleteFileRequest(BaseModel):
-    file_id: int
\ No newline at end of file
+    file_id: int
+
+class DeleteFilesRequest(BaseModel):
+    file_ids: List[int]
+
+class IngestionJobInfo(BaseModel):
+    id: str
+    file_id: int
+    filename: str
+    status: str
+    stage: str
+    progress: dict = {}
+    error: Optional[str] = None
+    action: str = "index"
+    created_at: datetime
+    updated_at: datetime
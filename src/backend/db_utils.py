@@ -1,4 +1,5 @@
 import sqlite3
+import json
 from datetime import datetime
 
 DB_NAME = "rag_app.db"
@@ -47,15 +48,67 @@ def create_document_store():
                      upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     conn.close()
 
-def insert_document_record(filename):
+def migrate_document_store():
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO document_store (filename) VALUES (?)', (filename,))
-    file_id = cursor.lastrowid
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(document_store)')]
+    if 'content_hash' not in columns:
+        conn.execute('ALTER TABLE document_store ADD COLUMN content_hash TEXT')
+    # One document per distinct content; concurrent identical uploads race on this index
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_document_store_content_hash
+                    ON document_store (content_hash) WHERE content_hash IS NOT NULL''')
     conn.commit()
     conn.close()
+
+def insert_document_record(filename, content_hash=None):
+    """
+    Raises sqlite3.IntegrityError if a document with the same content_hash already exists.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO document_store (filename, content_hash) VALUES (?, ?)', (filename, content_hash))
+        file_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        # A failed statement leaves its write transaction open until the connection closes
+        conn.close()
     return file_id
 
+def get_document_record(file_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, filename, content_hash, upload_timestamp FROM document_store WHERE id = ?', (file_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def update_document_record(file_id, filename, content_hash):
+    conn = get_db_connection()
+    conn.execute('UPDATE document_store SET filename = ?, content_hash = ?, upload_timestamp = CURRENT_TIMESTAMP WHERE id = ?',
+                 (filename, content_hash, file_id))
+    conn.commit()
+    conn.close()
+
+def set_document_content_hash(file_id, content_hash):
+    """
+    Raises sqlite3.IntegrityError if another document already has this content_hash.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('UPDATE document_store SET content_hash = ? WHERE id = ?', (content_hash, file_id))
+        conn.commit()
+    finally:
+        # A failed statement leaves its write transaction open until the connection closes
+        conn.close()
+
+def get_document_by_hash(content_hash):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, filename, upload_timestamp FROM document_store WHERE content_hash = ?', (content_hash,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
 def delete_document_record(file_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM document_store WHERE id = ?', (file_id,))
@@ -63,6 +116,18 @@ def delete_document_record(file_id):
     conn.close()
     return True
 
+def delete_document_records(file_ids):
+    """
+    Delete several documents in one transaction. Returns the number of rows deleted.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM document_store WHERE id = ?', [(file_id,) for file_id in file_ids])
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
 def get_all_documents():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -71,6 +136,115 @@ def get_all_documents():
     conn.close()
     return [dict(doc) for doc in documents]
 
+def create_ingestion_jobs():
+    conn = get_db_connection()
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingestion_jobs
+                    (id TEXT PRIMARY KEY,
+                     file_id INTEGER,
+                     filename TEXT,
+                     file_path TEXT,
+                     status TEXT DEFAULT 'queued',
+                     stage TEXT DEFAULT 'queued',
+                     progress TEXT DEFAULT '{}',
+                     error TEXT,
+                     action TEXT DEFAULT 'index',
+                     content_hash TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.close()
+
+def migrate_ingestion_jobs():
+    conn = get_db_connection()
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(ingestion_jobs)')]
+    if 'action' not in columns:
+        conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN action TEXT DEFAULT 'index'")
+    if 'content_hash' not in columns:
+        conn.execute('ALTER TABLE ingestion_jobs ADD COLUMN content_hash TEXT')
+    conn.commit()
+    conn.close()
+
+def _job_row_to_dict(row):
+    job = dict(row)
+    job['progress'] = json.loads(job['progress'] or '{}')
+    return job
+
+def insert_ingestion_job(job_id, file_id, filename, file_path, action='index', content_hash=None):
+    conn = get_db_connection()
+    conn.execute('INSERT INTO ingestion_jobs (id, file_id, filename, file_path, action, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                 (job_id, file_id, filename, file_path, action, content_hash))
+    conn.commit()
+    conn.close()
+
+def update_ingestion_job(job_id, status=None, stage=None, progress=None, error=None):
+    updates = {"status": status, "stage": stage, "error": error}
+    if progress is not None:
+        updates["progress"] = json.dumps(progress)
+    updates = {column: value for column, value in updates.items() if value is not None}
+
+    assignments = ", ".join(f"{column} = ?" for column in updates)
+    conn = get_db_connection()
+    conn.execute(f'UPDATE ingestion_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                 (*updates.values(), job_id))
+    conn.commit()
+    conn.close()
+
+def get_ingestion_job(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM ingestion_jobs WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return _job_row_to_dict(row) if row else None
+
+def get_ingestion_jobs(status=None, limit=100):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if status:
+        cursor.execute('SELECT * FROM ingestion_jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?', (status, limit))
+    else:
+        cursor.execute('SELECT * FROM ingestion_jobs ORDER BY created_at DESC LIMIT ?', (limit,))
+    jobs = cursor.fetchall()
+    conn.close()
+    return [_job_row_to_dict(job) for job in jobs]
+
+def get_unfinished_ingestion_jobs():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM ingestion_jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+    jobs = cursor.fetchall()
+    conn.close()
+    return [_job_row_to_dict(job) for job in jobs]
+
+def create_corpus_state():
+    conn = get_db_connection()
+    conn.execute('''CREATE TABLE IF NOT EXISTS corpus_state
+                    (id INTEGER PRIMARY KEY CHECK (id = 1),
+                     version INTEGER NOT NULL)''')
+    conn.execute('INSERT OR IGNORE INTO corpus_state (id, version) VALUES (1, 0)')
+    conn.commit()
+    conn.close()
+
+def get_corpus_version():
+    conn = get_db_connection()
+    version = conn.execute('SELECT version FROM corpus_state WHERE id = 1').fetchone()['version']
+    conn.close()
+    return version
+
+def bump_corpus_version():
+    """
+    Record that the searchable corpus changed; answers cached for earlier versions stop matching.
+    """
+    conn = get_db_connection()
+    conn.execute('UPDATE corpus_state SET version = version + 1 WHERE id = 1')
+    version = conn.execute('SELECT version FROM corpus_state WHERE id = 1').fetchone()['version']
+    conn.commit()
+    conn.close()
+    return version
+
 # Initialize the database tables
 create_application_logs()
-create_document_store()
\ No newline at end of file
+create_document_store()
+migrate_document_store()
+create_ingestion_jobs()
+migrate_ingestion_jobs()
+create_corpus_state()
\ No newline at end of file
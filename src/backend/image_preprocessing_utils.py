@@ -0,0 +1,109 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+# Named preprocessing policies for images sent to the vision model.
+# dpi caps PDF page rendering, max_side caps the longest edge in pixels,
+# format=None keeps the original encoding when nothing else changed.
+PREPROCESSING_POLICIES = {
+    "none": {"dpi": 200, "max_side": None, "grayscale": False, "crop_margins": False,
+             "format": None, "quality": None},
+    "balanced": {"dpi": 150, "max_side": 2048, "grayscale": True, "crop_margins": True,
+                 "format": "JPEG", "quality": 80},
+    "aggressive": {"dpi": 110, "max_side": 1400, "grayscale": True, "crop_margins": True,
+                   "format": "WEBP", "quality": 60},
+}
+
+IMAGE_PREPROCESSING_POLICY = os.getenv("IMAGE_PREPROCESSING_POLICY", "balanced")
+# DPI PDF pages were rendered at before preprocessing policies existed
+BASELINE_DPI = PREPROCESSING_POLICIES["none"]["dpi"]
+# EXIF orientation tag; phone photos are often stored sideways with this set
+EXIF_ORIENTATION = 0x0112
+
+# Pixels darker than (255 - threshold) count as content when cropping white margins
+MARGIN_THRESHOLD = 20
+MARGIN_PADDING = 16
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def get_policy(policy=None) -> dict:
+    if isinstance(policy, dict):
+        return policy
+    name = policy or IMAGE_PREPROCESSING_POLICY
+    if name not in PREPROCESSING_POLICIES:
+        raise ValueError(f"Unknown image preprocessing policy: {name}")
+    return PREPROCESSING_POLICIES[name]
+
+
+def crop_white_margins(img: Image.Image) -> Image.Image:
+    """
+    Crop near-white borders, keeping a little padding around the content.
+    """
+    mask = ImageOps.invert(img.convert("L")).point(lambda p: 255 if p > MARGIN_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+
+    left, top, right, bottom = bbox
+    return img.crop((
+        max(0, left - MARGIN_PADDING),
+        max(0, top - MARGIN_PADDING),
+        min(img.width, right + MARGIN_PADDING),
+        min(img.height, bottom + MARGIN_PADDING),
+    ))
+
+
+def preprocess_image_bytes(image_bytes: bytes, mime: str = "image/png", policy=None, dpi: int = None):
+    """
+    Apply a preprocessing policy to an encoded image (rendered page or uploaded JPG/PNG/TIFF).
+    Returns (image_bytes, mime, stats) where stats records payload bytes before and after.
+    For rendered PDF pages, dpi is the render DPI; bytes_before is measured at that DPI,
+    so stats also record it next to BASELINE_DPI.
+    """
+    policy = get_policy(policy)
+    img = Image.open(io.BytesIO(image_bytes))
+    img.seek(0)  # first frame of multi-page TIFFs
+
+    changed = False
+    # Re-encoding drops EXIF, so apply its orientation to the pixels first
+    if img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+        changed = True
+    original_size = img.size
+
+    if policy["crop_margins"]:
+        img = crop_white_margins(img)
+        changed = changed or img.size != original_size
+    if policy["max_side"] and max(img.size) > policy["max_side"]:
+        img = img.copy()
+        img.thumbnail((policy["max_side"], policy["max_side"]))
+        changed = True
+    if policy["grayscale"] and img.mode != "L":
+        img = img.convert("L")
+        changed = True
+
+    output_format = policy["format"]
+    if output_format is None and (changed or mime not in MIME_TYPES.values()):
+        # The vision API does not take TIFF, and edited images need re-encoding
+        output_format = "PNG"
+
+    if output_format is None:
+        out_bytes, out_mime = image_bytes, mime
+    else:
+        if output_format == "JPEG" and img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        save_kwargs = {"quality": policy["quality"]} if policy["quality"] else {}
+        img.save(buffer, format=output_format, **save_kwargs)
+        out_bytes, out_mime = buffer.getvalue(), MIME_TYPES[output_format]
+
+    stats = {
+        "bytes_before": len(image_bytes),
+        "bytes_after": len(out_bytes),
+        "width": img.width,
+        "height": img.height,
+    }
+    if dpi is not None:
+        stats.update({"dpi": dpi, "baseline_dpi": BASELINE_DPI})
+    return out_bytes, out_mime, stats
@@ -0,0 +1,165 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from vector_db_utils import index_document_to_chroma, update_document_in_chroma, delete_doc_from_chroma
+from lexical_index_utils import lexical_index
+from db_utils import (insert_ingestion_job, update_ingestion_job, get_ingestion_job,
+                      get_unfinished_ingestion_jobs, delete_document_record, update_document_record,
+                      get_document_record, set_document_content_hash, bump_corpus_version)
+
+# Ingestion throughput is bounded by the pool size, not by open HTTP connections
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+executor = ThreadPoolExecutor(max_workers=INGESTION_WORKERS, thread_name_prefix="ingestion")
+# One background thread for index maintenance, so compaction never runs on a request
+maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+_compaction_pending = threading.Event()
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def save_upload(file, job_id: str) -> tuple[str, str]:
+    """
+    Persist an uploaded file under UPLOAD_DIR so a queued job can still find it after a restart,
+    hashing the content while it streams to disk.
+    The job id prefix keeps concurrent uploads with the same filename apart.
+    Returns (file_path, sha256 hex digest).
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(UPLOAD_DIR, f"{job_id}_{os.path.basename(file.filename)}")
+    sha256 = hashlib.sha256()
+    with open(file_path, "wb") as buffer:
+        while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+            buffer.write(chunk)
+    return file_path, sha256.hexdigest()
+
+
+def submit_ingestion_job(job_id: str, file_path: str, filename: str, file_id: int,
+                         action: str = "index", content_hash: str = None) -> str:
+    """
+    Record a queued job for an already saved upload and hand it to the worker pool.
+    action is "index" for a new document or "update" to re-index a new version of file_id.
+    Returns the job id.
+    """
+    insert_ingestion_job(job_id, file_id, filename, file_path, action, content_hash)
+    executor.submit(run_ingestion_job, job_id)
+    return job_id
+
+
+def run_ingestion_job(job_id: str):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        return
+
+    progress = job["progress"]
+    is_update = job["action"] == "update"
+    previous_hash = None
+    hash_reserved = False
+    success = False
+
+    def on_stage(stage, **details):
+        progress[stage] = {"started_at": _now(), **details}
+        update_ingestion_job(job_id, status="running", stage=stage, progress=progress)
+
+    try:
+        on_stage("started")
+        if get_document_record(job["file_id"]) is None:
+            raise ValueError(f"{job['filename']} was deleted before indexing started.")
+        if is_update:
+            # Reserve the new content hash before touching Chroma, so a document uploaded with
+            # the same bytes while this job was queued fails the update instead of its record update
+            previous_hash = get_document_record(job["file_id"])["content_hash"]
+            try:
+                set_document_content_hash(job["file_id"], job["content_hash"])
+            except sqlite3.IntegrityError:
+                raise ValueError(f"{job['filename']} is identical to a document uploaded after this update was queued.")
+            hash_reserved = True
+            success = update_document_in_chroma(job["file_path"], job["file_id"], progress_callback=on_stage)
+        else:
+            success = index_document_to_chroma(job["file_path"], job["file_id"], progress_callback=on_stage)
+
+        if success and get_document_record(job["file_id"]) is None:
+            # Deleted while this job was writing: nothing else would ever remove these chunks
+            delete_doc_from_chroma(job["file_id"])
+            update_ingestion_job(job_id, status="failed", stage="failed",
+                                 error=f"{job['filename']} was deleted while it was being indexed.")
+        elif success:
+            if is_update:
+                update_document_record(job["file_id"], job["filename"], job["content_hash"])
+            bump_corpus_version()
+            progress["completed"] = {"started_at": _now()}
+            update_ingestion_job(job_id, status="completed", stage="completed", progress=progress)
+        else:
+            # A failed update has already restored the previous version in Chroma
+            if is_update:
+                set_document_content_hash(job["file_id"], previous_hash)
+            else:
+                delete_document_record(job["file_id"])
+            update_ingestion_job(job_id, status="failed", stage="failed",
+                                 error=f"Failed to index {job['filename']}.")
+    except Exception as e:
+        logging.exception(f"Ingestion job {job_id} failed")
+        if not is_update:
+            delete_document_record(job["file_id"])
+        elif hash_reserved and not success:
+            set_document_content_hash(job["file_id"], previous_hash)
+        update_ingestion_job(job_id, status="failed", stage="failed", error=str(e))
+    finally:
+        if os.path.exists(job["file_path"]):
+            os.remove(job["file_path"])
+
+
+def schedule_compaction():
+    """
+    Queue a compaction of the local indexes after deletes. Requests that arrive while
+    one is already queued are folded into it.
+    """
+    if _compaction_pending.is_set():
+        return False
+    _compaction_pending.set()
+    maintenance_executor.submit(run_compaction)
+    return True
+
+
+def run_compaction():
+    _compaction_pending.clear()
+    try:
+        start = datetime.utcnow()
+        # rag_app.db is left alone: a VACUUM would rewrite the chat logs too and lock out
+        # ingestion job updates for the whole rewrite, to reclaim a few document rows.
+        # The lexical index vacuums incrementally and stays writable throughout.
+        lexical_index.compact()
+        logging.info(f"Compaction finished in {(datetime.utcnow() - start).total_seconds():.2f}s")
+    except Exception:
+        logging.exception("Compaction failed")
+
+
+def resume_ingestion_jobs():
+    """
+    Re-queue jobs that were queued or running when the process stopped.
+    Jobs that were mid-way through indexing have their partial chunks removed first.
+    """
+    for job in get_unfinished_ingestion_jobs():
+        if not os.path.exists(job["file_path"]):
+            if job["action"] != "update":
+                delete_document_record(job["file_id"])
+            update_ingestion_job(job["id"], status="failed", stage="failed",
+                                 error="Uploaded file was lost before indexing finished.")
+            continue
+
+        # Updates diff against what is in Chroma, so re-running one is safe as is
+        if job["status"] == "running" and job["action"] != "update":
+            delete_doc_from_chroma(job["file_id"])
+
+        update_ingestion_job(job["id"], status="queued", stage="queued", progress={})
+        executor.submit(run_ingestion_job, job["id"])
+        logging.info(f"Resumed ingestion job {job['id']} for file_id {job['file_id']}")
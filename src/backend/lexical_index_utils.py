@@ -0,0 +1,290 @@
+import os
+import re
+import math
+import json
+import sqlite3
+import threading
+from collections import Counter
+from typing import List, Optional, Tuple
+from langchain_core.documents import Document
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "lexical_index.db")
+
+# Standard Okapi BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Query terms that match more than this share of the searched chunks carry almost no ranking
+# signal and are dropped before their postings are read. The ceiling only applies once the
+# searched scope holds LEXICAL_DF_CEILING_MIN_CHUNKS chunks, so small files are searched in full.
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", "0.5"))
+LEXICAL_DF_CEILING_MIN_CHUNKS = int(os.getenv("LEXICAL_DF_CEILING_MIN_CHUNKS", "1000"))
+
+# Free pages returned to the filesystem per incremental_vacuum step. Compaction takes the
+# write lock one step at a time, so indexing and searches interleave with it.
+LEXICAL_VACUUM_STEP_PAGES = int(os.getenv("LEXICAL_VACUUM_STEP_PAGES", "256"))
+
+# Chunk ids per IN (...) clause, below SQLite's bound-variable limit
+SQL_BATCH_SIZE = 500
+
+# Dropped from queries only; the index itself keeps every term
+STOPWORDS = frozenset("""
+a about an and are as at be but by can do does for from had has have how i if in is it its
+me my no not of on or our so than that the their them then there these they this to was we
+were what when where which who whom why will with you your
+""".split())
+
+# Words, numbers and identifiers such as "ab-1234", "555-123-4567" or "2024/01/31"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-/.:][a-z0-9]+)*")
+TOKEN_SEPARATORS = re.compile(r"[-/.:]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased terms for the inverted index. Compound identifiers are indexed whole,
+    by part and with their separators removed, so "555-123-4567" also matches "5551234567".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = TOKEN_SEPARATORS.split(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+            terms.append("".join(parts))
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over chunk text, stored in SQLite next to the vector store.
+    Chunks are keyed by their Chroma id and scoped by file_id.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        conn = self._connect()
+        # Deleted pages go on a freelist that compact() hands back in small steps. The mode only
+        # applies to a new file, so an index created without it is rebuilt once here, at startup.
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('VACUUM')
+        # Readers never wait on a writer in WAL mode; the setting is stored in the file
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS lexical_chunks
+                        (chunk_id TEXT PRIMARY KEY,
+                         file_id INTEGER,
+                         length INTEGER,
+                         content TEXT,
+                         metadata TEXT)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_chunks_file_id ON lexical_chunks (file_id)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS lexical_postings
+                        (term TEXT,
+                         chunk_id TEXT,
+                         file_id INTEGER,
+                         tf INTEGER,
+                         PRIMARY KEY (term, chunk_id))''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_postings_chunk_id ON lexical_postings (chunk_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_postings_term_file_id ON lexical_postings (term, file_id)')
+        # Corpus statistics kept current on every write, so searches never rescan the tables
+        conn.execute('''CREATE TABLE IF NOT EXISTS lexical_terms
+                        (term TEXT PRIMARY KEY,
+                         df INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS lexical_stats
+                        (id INTEGER PRIMARY KEY CHECK (id = 1),
+                         chunk_count INTEGER,
+                         total_length INTEGER)''')
+        if conn.execute('SELECT 1 FROM lexical_stats').fetchone() is None:
+            # First start on an index built before the statistics tables existed
+            conn.execute('DELETE FROM lexical_terms')
+            conn.execute('INSERT INTO lexical_terms (term, df) SELECT term, COUNT(*) FROM lexical_postings GROUP BY term')
+            conn.execute('INSERT INTO lexical_stats (id, chunk_count, total_length) '
+                         'SELECT 1, COUNT(*), COALESCE(SUM(length), 0) FROM lexical_chunks')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _remove_chunks(conn, chunk_ids: List[str]):
+        """
+        Deletes chunks and their postings and takes them out of the corpus statistics.
+        Runs inside the caller's transaction.
+        """
+        removed_df, removed_chunks, removed_length = Counter(), 0, 0
+        for start in range(0, len(chunk_ids), SQL_BATCH_SIZE):
+            batch = chunk_ids[start:start + SQL_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            removed_df.update(dict(conn.execute(
+                f'SELECT term, COUNT(*) FROM lexical_postings WHERE chunk_id IN ({placeholders}) GROUP BY term', batch)))
+            count, length = conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_chunks WHERE chunk_id IN ({placeholders})',
+                batch).fetchone()
+            removed_chunks += count
+            removed_length += length
+            conn.execute(f'DELETE FROM lexical_postings WHERE chunk_id IN ({placeholders})', batch)
+            conn.execute(f'DELETE FROM lexical_chunks WHERE chunk_id IN ({placeholders})', batch)
+
+        if removed_df:
+            conn.executemany('UPDATE lexical_terms SET df = df - ? WHERE term = ?',
+                             [(df, term) for term, df in removed_df.items()])
+            conn.execute('DELETE FROM lexical_terms WHERE df <= 0')
+        conn.execute('UPDATE lexical_stats SET chunk_count = chunk_count - ?, total_length = total_length - ? WHERE id = 1',
+                     (removed_chunks, removed_length))
+
+    def add_chunks(self, chunk_ids: List[str], documents: List[Document]):
+        """
+        Index (or re-index) chunks. Each document's metadata must carry its file_id.
+        """
+        if not chunk_ids:
+            return
+        # A repeated id keeps its last document, as INSERT OR REPLACE used to
+        latest = dict(zip(chunk_ids, documents))
+        chunk_rows, posting_rows, added_df = [], [], Counter()
+        for chunk_id, doc in latest.items():
+            file_id = doc.metadata.get("file_id")
+            terms = Counter(tokenize(doc.page_content))
+            chunk_rows.append((chunk_id, file_id, sum(terms.values()), doc.page_content, json.dumps(doc.metadata)))
+            posting_rows.extend((term, chunk_id, file_id, tf) for term, tf in terms.items())
+            added_df.update(terms.keys())
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                self._remove_chunks(conn, list(latest))
+                conn.executemany('INSERT INTO lexical_chunks (chunk_id, file_id, length, content, metadata) VALUES (?, ?, ?, ?, ?)',
+                                 chunk_rows)
+                conn.executemany('INSERT INTO lexical_postings (term, chunk_id, file_id, tf) VALUES (?, ?, ?, ?)', posting_rows)
+                conn.executemany('INSERT INTO lexical_terms (term, df) VALUES (?, ?) '
+                                 'ON CONFLICT (term) DO UPDATE SET df = df + excluded.df',
+                                 list(added_df.items()))
+                conn.execute('UPDATE lexical_stats SET chunk_count = chunk_count + ?, total_length = total_length + ? WHERE id = 1',
+                             (len(chunk_rows), sum(row[2] for row in chunk_rows)))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def delete_chunks(self, chunk_ids: List[str]):
+        if not chunk_ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                self._remove_chunks(conn, list(dict.fromkeys(chunk_ids)))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def delete_file(self, file_id: int):
+        self.delete_files([file_id])
+
+    def delete_files(self, file_ids: List[int]):
+        if not file_ids:
+            return
+        placeholders = ",".join("?" * len(file_ids))
+        with self._lock:
+            conn = self._connect()
+            try:
+                chunk_ids = [row[0] for row in conn.execute(
+                    f'SELECT chunk_id FROM lexical_chunks WHERE file_id IN ({placeholders})', list(file_ids))]
+                self._remove_chunks(conn, chunk_ids)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def compact(self):
+        """
+        Reclaim the space left by deleted chunks and refresh the query planner statistics.
+        Free pages are released LEXICAL_VACUUM_STEP_PAGES at a time, holding the lock only
+        for each step.
+        """
+        conn = self._connect()
+        try:
+            while True:
+                with self._lock:
+                    if not conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                        break
+                    # execute() steps a row-less statement once, which frees a single page;
+                    # executescript() runs it to completion
+                    conn.executescript(f'PRAGMA incremental_vacuum({LEXICAL_VACUUM_STEP_PAGES})')
+            conn.execute('PRAGMA optimize')
+        finally:
+            conn.close()
+
+    def count(self) -> int:
+        conn = self._connect()
+        total = conn.execute('SELECT chunk_count FROM lexical_stats WHERE id = 1').fetchone()[0]
+        conn.close()
+        return total
+
+    def search(self, query: str, file_ids: Optional[List[int]] = None, k: int = 8) -> List[Tuple[Document, float]]:
+        """
+        Returns up to k (Document, BM25 score) pairs, best first, for chunks that share
+        at least one term with the query. file_ids restricts the search (and the corpus
+        statistics) to those documents. Stopwords and terms above the document-frequency
+        ceiling are ignored, and scoring runs in SQLite so only the top k rows are read.
+        """
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term not in STOPWORDS]
+        if not terms or file_ids == []:
+            return []
+
+        def scope(column):
+            return "" if file_ids is None else f" AND {column} IN ({','.join('?' * len(file_ids))})"
+        scope_params = [] if file_ids is None else list(file_ids)
+        term_placeholders = ",".join("?" * len(terms))
+
+        conn = self._connect()
+        try:
+            if file_ids is None:
+                n_chunks, total_length = conn.execute(
+                    'SELECT chunk_count, total_length FROM lexical_stats WHERE id = 1').fetchone()
+                document_frequency = dict(conn.execute(
+                    f'SELECT term, df FROM lexical_terms WHERE term IN ({term_placeholders})', terms))
+            else:
+                # Scoped statistics come from the file_id indexes and only touch the searched files
+                n_chunks, total_length = conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_chunks WHERE 1 = 1{scope("file_id")}',
+                    scope_params).fetchone()
+                document_frequency = dict(conn.execute(
+                    f'SELECT term, COUNT(*) FROM lexical_postings WHERE term IN ({term_placeholders}){scope("file_id")} GROUP BY term',
+                    terms + scope_params))
+            if not n_chunks:
+                return []
+
+            max_df = LEXICAL_MAX_DF_RATIO * n_chunks if n_chunks >= LEXICAL_DF_CEILING_MIN_CHUNKS else n_chunks
+            idf = {term: math.log(1 + (n_chunks - df + 0.5) / (df + 0.5))
+                   for term, df in document_frequency.items() if df <= max_df}
+            if not idf:
+                return []
+
+            avg_length = total_length / n_chunks or 1
+            query_terms = " UNION ALL ".join("SELECT ?, ?" for _ in idf)
+            top = conn.execute(
+                f'''WITH q (term, idf) AS ({query_terms})
+                    SELECT p.chunk_id,
+                           SUM(q.idf * p.tf * ? / (p.tf + ? * (1 - ? + ? * c.length / ?))) AS score
+                    FROM q CROSS JOIN lexical_postings p ON p.term = q.term
+                    JOIN lexical_chunks c ON c.chunk_id = p.chunk_id
+                    WHERE 1 = 1{scope("p.file_id")}
+                    GROUP BY p.chunk_id
+                    ORDER BY score DESC
+                    LIMIT ?''',
+                [value for item in idf.items() for value in item]
+                + [BM25_K1 + 1, BM25_K1, BM25_B, BM25_B, avg_length] + scope_params + [k]).fetchall()
+
+            rows = {}
+            if top:
+                placeholders = ",".join("?" * len(top))
+                rows = {chunk_id: (content, metadata) for chunk_id, content, metadata in conn.execute(
+                    f'SELECT chunk_id, content, metadata FROM lexical_chunks WHERE chunk_id IN ({placeholders})',
+                    [chunk_id for chunk_id, _ in top])}
+        finally:
+            conn.close()
+
+        return [(Document(page_content=rows[chunk_id][0], metadata=json.loads(rows[chunk_id][1]), id=chunk_id), score)
+                for chunk_id, score in top if chunk_id in rows]
+
+
+lexical_index = LexicalIndex(LEXICAL_INDEX_PATH)
@@ -1,17 +1,20 @@
-from fastapi import FastAPI, File, UploadFile,HTTPException
-from data_validation_utils import QueryInput,QueryResponse, DocumentInfo ,DeleteFileRequest
-from query_translation_utils import get_rag_chain, get_summarization_chain , get_field_extraction_chain
-from vector_db_utils import index_document_to_chroma,delete_doc_from_chroma,get_relevant_chunks_from_chroma
-from db_utils import insert_application_logs,get_chat_history,get_all_documents,insert_document_record,delete_document_record
+from fastapi import FastAPI, File, Form, UploadFile,HTTPException
+from fastapi.responses import StreamingResponse
+from data_validation_utils import QueryInput,QueryResponse, DocumentInfo ,DeleteFileRequest, DeleteFilesRequest, IngestionJobInfo, ModelName
+from query_translation_utils import (get_summarization_chain , get_field_extraction_chain, get_insights_chain, prebuild_chains,
+                                     get_answer_chain, rewrite_question, retriever, answer_cache, is_lexical_query)
+from openai_client_utils import close_http_clients
+from vector_db_utils import delete_doc_from_chroma,delete_docs_from_chroma,get_relevant_chunks_from_chroma,embedding_function,flat_index
+from parsing_utils import vision_cache, shutdown_pdf_process_pool
+from db_utils import insert_application_logs,get_chat_history,get_all_documents,insert_document_record,delete_document_record,get_ingestion_job,get_ingestion_jobs,get_document_by_hash,get_document_record,delete_document_records,get_corpus_version,bump_corpus_version
+from ingestion_utils import save_upload, submit_ingestion_job, resume_ingestion_jobs, schedule_compaction, executor as ingestion_executor, maintenance_executor
 from fastapi import Body, HTTPException
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.chains import LLMChain
-from vector_db_utils import get_relevant_chunks_from_chroma
+from vector_db_utils import get_relevant_chunks_from_chroma, get_relevant_chunks_for_queries, get_relevant_chunks_across_files, backfill_lexical_index
 import optparse
 import uuid
+import time
+import sqlite3
 import logging
-import shutil
 import os
 from fastapi import Body
 import json 
@@ -20,10 +23,79 @@ logging.basicConfig(filename='app.log',level=logging.INFO)
 
 app=FastAPI()
 
+BULK_UPLOAD_POLL_SECONDS = 0.5
+
+@app.on_event("startup")
+def resume_pending_ingestion_jobs():
+    backfill_lexical_index()
+    resume_ingestion_jobs()
+    prebuild_chains([model.value for model in ModelName])
+
+@app.on_event("shutdown")
+def stop_ingestion_workers():
+    ingestion_executor.shutdown(wait=False, cancel_futures=True)
+    maintenance_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_pdf_process_pool()
+
+@app.on_event("shutdown")
+async def close_openai_connections():
+    await close_http_clients()
+
 @app.get("/status")
 async def checking_status():
     return {"status":"ok"}
 
+@app.get("/cache-stats")
+def cache_stats():
+    return {"vision": vision_cache.stats(), "embeddings": embedding_function.stats(),
+            "flat_index": flat_index.stats() if flat_index is not None else None,
+            "answers": answer_cache.stats() if answer_cache is not None else None}
+
+def format_sources(source_docs) -> list:
+    sources = []
+    for d in source_docs:
+        meta = d.metadata or {}
+        sources.append({
+            "source": meta.get("source"),
+            "page_number": meta.get("page_number") or meta.get("page"),
+            "chunk_preview": d.page_content[:300]  # small preview
+        })
+    return sources
+
+def lookup_answer_cache(question: str, chat_history: list, model: str):
+    """
+    Rewrite the question to its standalone form and look it up in the answer cache.
+    Returns (standalone_question, cache_key, cached answer or None); cache_key is
+    (model, corpus version, standalone question), or None when caching is off.
+    The question is only embedded when there is no exact match, and never for
+    lexical lookups, which only match exactly.
+    """
+    standalone_question = rewrite_question(question, chat_history, model)
+    if answer_cache is None:
+        return standalone_question, None, None
+    cache_key = (model, get_corpus_version(), standalone_question)
+    embed = None
+    if not is_lexical_query(standalone_question):
+        embed = lambda: embedding_function.embed_query(standalone_question)
+    return standalone_question, cache_key, answer_cache.lookup(*cache_key, embed=embed)
+
+def store_cached_answer(cache_key, answer: str, sources: list):
+    model, corpus_version, question = cache_key
+    # Retrieval has already embedded the question, so this is an embedding cache hit
+    embedding = None if is_lexical_query(question) else embedding_function.embed_query(question)
+    answer_cache.store(model, corpus_version, question, embedding, answer, sources)
+
+def cache_metadata(cache_key, cached):
+    if cache_key is None:
+        return None
+    metadata = {"hit": cached is not None, "corpus_version": cache_key[1]}
+    if cached is not None:
+        metadata.update({key: cached[key] for key in ("similarity", "matched_question", "cached_at")})
+    return metadata
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.post("/chat",response_model=QueryResponse)
 def chat(query_input: QueryInput):
     session_id = query_input.session_id
@@ -34,32 +106,26 @@ def chat(query_input: QueryInput):
     
 
     chat_history = get_chat_history(session_id)
-    rag_chain = get_rag_chain(query_input.model.value)
-    result = rag_chain.invoke({
-        "input": query_input.question,
-        "chat_history": chat_history
-    })
-
-    answer = result["answer"]
-    
+    model = query_input.model.value
+    standalone_question, cache_key, cached = lookup_answer_cache(query_input.question, chat_history, model)
 
+    if cached is not None:
+        answer, sources = cached["answer"], cached["sources"]
+    else:
+        # History-aware RAG, reusing the standalone question from the cache lookup
+        source_docs = retriever.invoke(standalone_question)
+        answer = get_answer_chain(model).invoke({
+            "input": query_input.question,
+            "chat_history": chat_history,
+            "context": source_docs
+        })
+        sources = format_sources(source_docs)
+        if cache_key is not None and answer:
+            store_cached_answer(cache_key, answer, sources)
 
-    
     # insert_application_logs(session_id, query_input.question, answer, query_input.model.value)
     # logging.info(f"Session ID: {session_id}, AI Response: {answer}")
     # return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
-    
-    source_docs = result.get("context", [])  # context contains retrieved docs
-
-    sources = []
-    for d in source_docs:
-        meta = d.metadata or {}
-        sources.append({
-            "source": meta.get("source"),
-            "page_number": meta.get("page_number") or meta.get("page"),
-            "chunk_preview": d.page_content[:300]  # small preview
-        })
-
 
     insert_application_logs(session_id, query_input.question, answer, query_input.model.value)
     logging.info(f"Session ID: {session_id}, AI Response: {answer}")
@@ -68,36 +134,215 @@ def chat(query_input: QueryInput):
         answer=answer,
         session_id=session_id,
         model=query_input.model.value,
-        sources=sources
+        sources=sources,
+        cache=cache_metadata(cache_key, cached)
     )
 
 
-@app.post("/upload-doc")
-def upload_and_index_document(file: UploadFile = File(...)):
-    allowed_extensions = ['.pdf', '.docx', '.html', '.jpg', '.jpeg', '.png', '.tiff', '.tif']
-    file_extension = os.path.splitext(file.filename)[1].lower()
-    
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
+@app.post("/chat/stream")
+def chat_stream(query_input: QueryInput):
+    """
+    Streaming variant of /chat as server-sent events:
+    "session" first, "sources" once retrieval is done, one "token" per answer chunk,
+    then "done" with the full answer after the exchange is logged ("error" on failure).
+    """
+    session_id = query_input.session_id
+    logging.info(f"Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value}, Streaming")
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    model = query_input.model.value
+
+    chat_history = get_chat_history(session_id)
+
+    def events():
+        yield sse_event("session", {"session_id": session_id, "model": model})
+        try:
+            standalone_question, cache_key, cached = lookup_answer_cache(query_input.question, chat_history, model)
+            if cached is not None:
+                answer = cached["answer"]
+                yield sse_event("sources", cached["sources"])
+                yield sse_event("token", {"text": answer})
+            else:
+                source_docs = retriever.invoke(standalone_question)
+                sources = format_sources(source_docs)
+                yield sse_event("sources", sources)
+
+                answer_parts = []
+                for token in get_answer_chain(model).stream({
+                    "input": query_input.question,
+                    "chat_history": chat_history,
+                    "context": source_docs
+                }):
+                    if token:
+                        answer_parts.append(token)
+                        yield sse_event("token", {"text": token})
+                answer = "".join(answer_parts)
+                if cache_key is not None and answer:
+                    store_cached_answer(cache_key, answer, sources)
+        except Exception as e:
+            logging.exception(f"Session ID: {session_id}, streaming failed")
+            yield sse_event("error", {"detail": str(e)})
+            return
+
+        insert_application_logs(session_id, query_input.question, answer, model)
+        logging.info(f"Session ID: {session_id}, AI Response: {answer}")
+        yield sse_event("done", {"answer": answer, "session_id": session_id, "model": model,
+                                 "cache": cache_metadata(cache_key, cached)})
+
+    # X-Accel-Buffering stops a reverse proxy from holding tokens back
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+ALLOWED_EXTENSIONS = ['.pdf', '.docx', '.html', '.jpg', '.jpeg', '.png', '.tiff', '.tif']
+
+def validate_extension(filename: str):
+    file_extension = os.path.splitext(filename)[1].lower()
     
-    temp_file_path = f"temp_{file.filename}"
+    if file_extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(ALLOWED_EXTENSIONS)}")
+
+def accept_upload(file: UploadFile) -> dict:
+    """
+    Validate, save and deduplicate one upload, then queue it for indexing.
+    Raises HTTPException for unsupported types or if the job cannot be queued.
+    """
+    validate_extension(file.filename)
     
+    job_id = str(uuid.uuid4())
+    file_path, content_hash = save_upload(file, job_id)
+
+    # Byte-identical content is only parsed and embedded once
+    existing_doc = get_document_by_hash(content_hash)
+    file_id = None
+    if existing_doc is None:
+        try:
+            file_id = insert_document_record(file.filename, content_hash)
+        except sqlite3.IntegrityError:
+            # An identical upload was recorded between the lookup and the insert
+            existing_doc = get_document_by_hash(content_hash)
+
+    if existing_doc is not None:
+        os.remove(file_path)
+        return {
+            "message": f"File {file.filename} is identical to already uploaded {existing_doc['filename']}.",
+            "file_id": existing_doc["id"],
+            "job_id": None,
+            "status": "duplicate"
+        }
+
+    # Parsing, vision extraction and embedding run on the ingestion worker pool;
+    # poll /jobs/{job_id} for progress.
     try:
-        # Save the uploaded file to a temporary file
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        file_id = insert_document_record(file.filename)
-        success = index_document_to_chroma(temp_file_path, file_id)
-        
-        if success:
-            return {"message": f"File {file.filename} has been successfully uploaded and indexed.", "file_id": file_id}
-        else:
-            delete_document_record(file_id)
-            raise HTTPException(status_code=500, detail=f"Failed to index {file.filename}.")
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        submit_ingestion_job(job_id, file_path, file.filename, file_id)
+    except Exception as e:
+        delete_document_record(file_id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise HTTPException(status_code=500, detail=f"Failed to queue {file.filename}: {e}")
+
+    return {
+        "message": f"File {file.filename} has been uploaded and queued for indexing.",
+        "file_id": file_id,
+        "job_id": job_id,
+        "status": "queued"
+    }
+
+@app.post("/upload-doc")
+def upload_and_index_document(file: UploadFile = File(...)):
+    return accept_upload(file)
+
+@app.post("/upload-docs")
+def upload_and_index_documents(files: list[UploadFile] = File(...)):
+    """
+    Queue many files in one request and stream per-file progress as NDJSON.
+    Every line is a JSON object with an "event" key: queued/duplicate/rejected once per file,
+    progress on each stage change, completed/failed when a job settles, and a final done.
+    """
+    results = []
+    for file in files:
+        try:
+            result = accept_upload(file)
+        except HTTPException as e:
+            result = {"message": e.detail, "file_id": None, "job_id": None, "status": "rejected"}
+        results.append({"filename": file.filename, **result})
+
+    def progress_events():
+        pending = {}
+        for result in results:
+            yield json.dumps({"event": result["status"], **result}) + "\n"
+            if result["status"] == "queued":
+                pending[result["job_id"]] = None
+
+        while pending:
+            for job_id, last_stage in list(pending.items()):
+                job = get_ingestion_job(job_id)
+                if job["status"] in ("completed", "failed"):
+                    del pending[job_id]
+                    failed_pages = job["progress"].get("chunking", {}).get("failed_pages", [])
+                    yield json.dumps({"event": job["status"], "job_id": job_id, "file_id": job["file_id"],
+                                      "filename": job["filename"], "error": job["error"],
+                                      "failed_pages": failed_pages}) + "\n"
+                elif job["stage"] != last_stage:
+                    pending[job_id] = job["stage"]
+                    yield json.dumps({"event": "progress", "job_id": job_id, "file_id": job["file_id"],
+                                      "filename": job["filename"], "stage": job["stage"],
+                                      "progress": job["progress"]}) + "\n"
+            if pending:
+                time.sleep(BULK_UPLOAD_POLL_SECONDS)
+
+        yield json.dumps({"event": "done", "total": len(results)}) + "\n"
+
+    return StreamingResponse(progress_events(), media_type="application/x-ndjson")
+
+@app.post("/update-doc")
+def update_and_reindex_document(file_id: int = Form(...), file: UploadFile = File(...)):
+    """
+    Replace an indexed document with a new version. Only chunks that changed are
+    re-embedded; poll /jobs/{job_id} for progress and the chunk diff.
+    """
+    document = get_document_record(file_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail=f"No document with file_id {file_id}")
+    validate_extension(file.filename)
+
+    job_id = str(uuid.uuid4())
+    file_path, content_hash = save_upload(file, job_id)
+
+    if content_hash == document["content_hash"]:
+        os.remove(file_path)
+        return {"message": f"File {file.filename} is identical to the indexed version.",
+                "file_id": file_id, "job_id": None, "status": "unchanged"}
+
+    existing_doc = get_document_by_hash(content_hash)
+    if existing_doc is not None:
+        os.remove(file_path)
+        raise HTTPException(status_code=409, detail=f"File {file.filename} is identical to document {existing_doc['id']}.")
+
+    try:
+        submit_ingestion_job(job_id, file_path, file.filename, file_id, action="update", content_hash=content_hash)
+    except Exception as e:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise HTTPException(status_code=500, detail=f"Failed to queue {file.filename}: {e}")
+
+    return {
+        "message": f"File {file.filename} has been uploaded and queued for re-indexing.",
+        "file_id": file_id,
+        "job_id": job_id,
+        "status": "queued"
+    }
+
+@app.get("/jobs/{job_id}", response_model=IngestionJobInfo)
+def get_job_status(job_id: str):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No ingestion job with id {job_id}")
+    return job
+
+@app.get("/jobs", response_model=list[IngestionJobInfo])
+def list_jobs(status: str = None, limit: int = 100):
+    return get_ingestion_jobs(status=status, limit=limit)
 
 @app.get("/list-docs", response_model=list[DocumentInfo])
 def list_documents():
@@ -109,6 +354,7 @@ def delete_document(request: DeleteFileRequest):
     chroma_delete_success = delete_doc_from_chroma(request.file_id)
 
     if chroma_delete_success:
+        bump_corpus_version()
         # If successfully deleted from Chroma, delete from our database
         db_delete_success = delete_document_record(request.file_id)
         if db_delete_success:
@@ -119,6 +365,29 @@ def delete_document(request: DeleteFileRequest):
         return {"error": f"Failed to delete document with file_id {request.file_id} from Chroma."}
 
 
+@app.post("/delete-docs")
+def delete_documents(request: DeleteFilesRequest):
+    """
+    Delete many documents at once: their chunks from Chroma and the lexical index,
+    then their document records. Index compaction runs afterwards in the background.
+    """
+    file_ids = list(dict.fromkeys(request.file_ids))
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="file_ids is required")
+
+    if not delete_docs_from_chroma(file_ids):
+        raise HTTPException(status_code=500, detail=f"Failed to delete documents with file_ids {file_ids} from Chroma.")
+
+    deleted_records = delete_document_records(file_ids)
+    bump_corpus_version()
+    compaction_scheduled = schedule_compaction()
+    return {
+        "message": f"Deleted {deleted_records} of {len(file_ids)} documents.",
+        "file_ids": file_ids,
+        "deleted_records": deleted_records,
+        "compaction": "scheduled" if compaction_scheduled else "already pending"
+    }
+
 @app.post("/summarize-docs")
 def summarize_documents(payload: dict = Body(...)):
 
@@ -160,12 +429,12 @@ def summarize_documents(payload: dict = Body(...)):
 
         # 3) Summarize each field/section separately
         section_summaries = []
-        for field_name in fields:
-            docs = get_relevant_chunks_from_chroma(
-                query=f"Extract details for section: {field_name}",
-                file_id=file_id,
-                k=10
-            )
+        section_docs = get_relevant_chunks_for_queries(
+            [f"Extract details for section: {field_name}" for field_name in fields],
+            file_id=file_id,
+            k=10
+        )
+        for field_name, docs in zip(fields, section_docs):
 
             if not docs:
                 continue
@@ -224,8 +493,9 @@ def generate_insights(payload: dict = Body(...)):
 
     # Collect evidence from each document separately
     per_doc = []
+    docs_by_file = get_relevant_chunks_across_files(question, file_ids, k=6)
     for file_id in file_ids:
-        docs = get_relevant_chunks_from_chroma(question, file_id=file_id, k=6)
+        docs = docs_by_file.get(file_id, [])
         context = "\n\n".join([d.page_content for d in docs])
 
         per_doc.append({
@@ -237,27 +507,7 @@ def generate_insights(payload: dict = Body(...)):
         [f"[DOC file_id={x['file_id']}]\n{x['context']}" for x in per_doc]
     )
 
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system",
-        "You are an Intelligent Form Agent. Answer using ONLY the provided document contexts. "
-        "Do not guess. If info is missing, say 'Not Found'. "
-        "Return ONLY valid JSON (no markdown)."
-        ),
-        ("human",
-        "Question: {question}\n\n"
-        "Document Contexts:\n{context}\n\n"
-        "Return JSON with these keys exactly:\n"
-        "answer, per_document, stats, recommendations.\n\n"
-        "Rules:\n"
-        "- per_document must be a list of objects with keys: file_id and finding\n"
-        "- stats must be a JSON object (can be empty)\n"
-        "- recommendations must be a list\n"
-        )
-    ])
-
-    chain = LLMChain(llm=llm, prompt=prompt)
+    chain = get_insights_chain(model="gpt-4o-mini")
     result = chain.run({"question": question, "context": combined_context})
 
     return {"result": result}
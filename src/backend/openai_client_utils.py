@@ -0,0 +1,38 @@
+import os
+import threading
+import httpx
+from langchain_openai import ChatOpenAI
+
+# Every OpenAI client in the process (chat models, embeddings, vision) shares these pooled
+# keep-alive HTTP clients, so requests reuse open connections instead of opening new ones
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))
+
+_limits = httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                       max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+http_client = httpx.Client(limits=_limits, timeout=OPENAI_TIMEOUT_SECONDS)
+async_http_client = httpx.AsyncClient(limits=_limits, timeout=OPENAI_TIMEOUT_SECONDS)
+
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+
+def get_chat_model(model: str = "gpt-4o-mini", temperature: float = None) -> ChatOpenAI:
+    """
+    Shared ChatOpenAI instance for (model, temperature), built on first use.
+    temperature=None keeps the API default.
+    """
+    key = (model, temperature)
+    with _chat_models_lock:
+        llm = _chat_models.get(key)
+        if llm is None:
+            kwargs = {} if temperature is None else {"temperature": temperature}
+            llm = ChatOpenAI(model=model, http_client=http_client, http_async_client=async_http_client, **kwargs)
+            _chat_models[key] = llm
+    return llm
+
+
+async def close_http_clients():
+    http_client.close()
+    await async_http_client.aclose()
@@ -6,47 +6,53 @@ from openai import OpenAI
 # from markitdown import MarkItDown
 # from docling.document_converter import DocumentConverter
 import fitz  # PyMuPDF
-from pathlib import Path
 import json
-import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from cache_utils import SQLiteLRUCache, sha256_hex
+from image_preprocessing_utils import preprocess_image_bytes, get_policy
+from pdf_worker_utils import extract_pdfium_page_range
+import logging
 
 from dotenv import load_dotenv
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
+# Max number of pages sent to the vision model at the same time
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "8"))
+
 
 
 
 
 import base64
 from openai import OpenAI
+from openai_client_utils import http_client
 
-client = OpenAI(api_key=api_key)
+client = OpenAI(api_key=api_key, http_client=http_client)
 
-def pdf_to_images(pdf_path: str, output_dir: str = "tmp_pdf_images", dpi: int = 200) -> list[str]:
+def render_pdf_pages(pdf_path: str, dpi: int = None, page_numbers=None):
     """
-    Convert PDF pages into PNG images.
-    Returns list of image file paths.
+    Render PDF pages to PNG bytes in memory, one page at a time.
+    dpi defaults to the active image preprocessing policy's DPI cap.
+    Yields (page_number, png_bytes) with 1-based page numbers; nothing is written to disk,
+    so concurrent requests cannot interfere with each other's pages.
+    page_numbers restricts rendering to those 1-based pages.
     """
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-
+    dpi = dpi or get_policy()["dpi"]
     doc = fitz.open(pdf_path)
-    image_paths = []
-
-    for i in range(len(doc)):
-        page = doc.load_page(i)
-
-        # Render page to pixmap
+    try:
         zoom = dpi / 72  # 72 is default DPI
         mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-
-        out_path = os.path.join(output_dir, f"{Path(pdf_path).stem}_page_{i+1}.png")
-        pix.save(out_path)
-        image_paths.append(out_path)
+        pages = page_numbers if page_numbers is not None else range(1, len(doc) + 1)
 
-    doc.close()
-    return image_paths
+        for page_no in pages:
+            page = doc.load_page(page_no - 1)
+            pix = page.get_pixmap(matrix=mat)
+            yield page_no, pix.tobytes("png")
+    finally:
+        doc.close()
 
 
 def guess_mime(image_path: str) -> str:
@@ -59,14 +65,9 @@ def guess_mime(image_path: str) -> str:
         return "image/tiff"
     return "image/png"
 
-def parsing_image(image_path: str):
-    # Read image and convert to base64
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+VISION_MODEL = "gpt-4o-mini"  # vision supported
 
-    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-
-    prompt = """
+VISION_PROMPT = """
 You are an Intelligent Form Agent.
 Extract key fields and values from this form image.
 
@@ -83,16 +84,39 @@ key_fields must be a list of objects with: field, value
 important_entities must include: people, organizations, dates, amounts, ids
 """
 
+# Editing VISION_PROMPT changes its version, so stale extractions are never served
+VISION_PROMPT_VERSION = sha256_hex(VISION_PROMPT)[:16]
+
+vision_cache = SQLiteLRUCache(
+    os.getenv("VISION_CACHE_PATH", "vision_cache.db"),
+    max_bytes=int(os.getenv("VISION_CACHE_MAX_MB", "256")) * 1024 * 1024,
+)
+
+def vision_cache_key(image_bytes: bytes) -> str:
+    return f"{VISION_MODEL}:{VISION_PROMPT_VERSION}:{sha256_hex(image_bytes)}"
+
+def parsing_image_bytes(image_bytes: bytes, mime: str = "image/png"):
+    """
+    Run vision extraction on an in-memory image.
+    Results are cached on disk by image hash, model and prompt version.
+    """
+    cache_key = vision_cache_key(image_bytes)
+    cached = vision_cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+
     resp = client.responses.create(
-        model="gpt-4o-mini",  # vision supported
+        model=VISION_MODEL,
         input=[
             {
                 "role": "user",
                 "content": [
-                    {"type": "input_text", "text": prompt},
+                    {"type": "input_text", "text": VISION_PROMPT},
                     {
                         "type": "input_image",
-                        "image_url": f"data:{guess_mime(image_path)};base64,{image_b64}"
+                        "image_url": f"data:{mime};base64,{image_b64}"
                     }
                 ]
             }
@@ -102,48 +126,76 @@ important_entities must include: people, organizations, dates, amounts, ids
     text = resp.output_text
 
     try:
-        return json.loads(text)
+        parsed = json.loads(text)
     except Exception:
+        # Not cached, so a retry gets another chance at valid JSON
         return {"raw_output": text}
 
+    vision_cache.put(cache_key, json.dumps(parsed).encode("utf-8"))
+    return parsed
+
+def parsing_image(image_path: str):
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+
+    image_bytes, mime, _ = preprocess_image_bytes(image_bytes, guess_mime(image_path))
+    return parsing_image_bytes(image_bytes, mime)
+
+
+# A PDF page whose text layer has fewer characters than this is sent to vision
+MIN_PAGE_TEXT_CHARS = int(os.getenv("MIN_PAGE_TEXT_CHARS", "50"))
 
-def cleanup_tmp_images(tmp_dir="tmp_pdf_images"):
-    if os.path.exists(tmp_dir):
-        shutil.rmtree(tmp_dir)
-        
 def is_text_poor(docs: list[Document], min_chars: int = 200) -> bool:
     total = sum(len(d.page_content.strip()) for d in docs if d.page_content)
     return total < min_chars
 
-def parse_scanned_pdf_with_vision(pdf_path: str) -> dict:
-    image_paths=[]
-    try:
-        """
-        Convert PDF pages to images and run vision extraction per page.
-        Returns merged JSON dict.
-        """
-        image_paths = pdf_to_images(pdf_path)
-
-        all_pages = []
-        for idx, img_path in enumerate(image_paths, start=1):
-            parsed = parsing_image(img_path)
-
-            # parsed might be dict or {"raw_output": "..."}
-            all_pages.append({
-                "page": idx,
-                "result": parsed
-            })
-
-        merged = {
-            "document_type": "Scanned PDF Form",
-            "source": pdf_path,
-            "pages": all_pages
-        }
+def log_payload(label: str, payload: dict):
+    rendered = f", rendered at {payload['dpi']} DPI (baseline {payload['baseline_dpi']})" if "dpi" in payload else ""
+    logging.info(f"Vision payload for {label}: {payload['bytes_before']} -> {payload['bytes_after']} bytes "
+                 f"({payload['width']}x{payload['height']}){rendered}")
 
-        return merged
-    finally:
-        # Cleanup temp images
-        cleanup_tmp_images()
+def _parse_page_safely(page_no: int, image_bytes: bytes, dpi: int) -> dict:
+    """
+    Run vision extraction for one page rendered at dpi; a failure is recorded on that page only.
+    """
+    try:
+        image_bytes, mime, payload = preprocess_image_bytes(image_bytes, "image/png", dpi=dpi)
+        log_payload(f"page {page_no}", payload)
+        return {"page": page_no, "result": parsing_image_bytes(image_bytes, mime), "payload": payload}
+    except Exception as e:
+        print(f"Vision extraction failed for page {page_no}: {e}")
+        return {"page": page_no, "result": {"error": str(e)}}
+
+def parse_scanned_pdf_with_vision(pdf_path: str, max_concurrency: int = VISION_CONCURRENCY,
+                                  page_numbers=None) -> dict:
+    """
+    Render PDF pages in memory and run vision extraction per page.
+    Pages are sent concurrently (at most max_concurrency in flight, which also bounds
+    how many rendered pages are held in memory) and reassembled in page order.
+    page_numbers restricts extraction to those 1-based pages.
+    Returns merged JSON dict.
+    """
+    all_pages = []
+    dpi = get_policy()["dpi"]
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="vision") as pool:
+        in_flight = set()
+        for page_no, image_bytes in render_pdf_pages(pdf_path, dpi=dpi, page_numbers=page_numbers):
+            if len(in_flight) >= max_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                all_pages.extend(f.result() for f in done)
+            in_flight.add(pool.submit(_parse_page_safely, page_no, image_bytes, dpi))
+
+        all_pages.extend(f.result() for f in in_flight)
+
+    all_pages.sort(key=lambda p: p["page"])
+
+    merged = {
+        "document_type": "Scanned PDF Form",
+        "source": pdf_path,
+        "pages": all_pages
+    }
+
+    return merged
         
 
 def json_to_retrieval_text(parsed: dict) -> str:
@@ -184,6 +236,37 @@ def json_to_retrieval_text(parsed: dict) -> str:
 
     return "\n".join([l for l in lines if l])
 
+# PDFs with at least this many pages are extracted in a process pool
+PDF_PROCESS_POOL_MIN_PAGES = int(os.getenv("PDF_PROCESS_POOL_MIN_PAGES", "50"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+# Workers live as long as the API process, so the default stays small on many-core hosts
+PDF_PROCESS_WORKERS = int(os.getenv("PDF_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_pdf_process_pool = None
+_pdf_process_pool_lock = threading.Lock()
+
+def get_pdf_process_pool() -> ProcessPoolExecutor:
+    global _pdf_process_pool
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is None:
+            # spawn, not fork: the parent runs ingestion/vision threads that may hold locks
+            _pdf_process_pool = ProcessPoolExecutor(max_workers=PDF_PROCESS_WORKERS,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_process_pool
+
+def pdf_process_pool_pids() -> list[int]:
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is None:
+            return []
+        return list(_pdf_process_pool._processes or {})
+
+def shutdown_pdf_process_pool():
+    global _pdf_process_pool
+    with _pdf_process_pool_lock:
+        if _pdf_process_pool is not None:
+            _pdf_process_pool.shutdown(wait=True, cancel_futures=True)
+            _pdf_process_pool = None
+
 def PARSING_PDF(parsing_strategy,pdf_path):
     if parsing_strategy=="PyPDFLoader":
         loader = PyPDFLoader(pdf_path)
@@ -215,13 +298,19 @@ def PARSING_PDF(parsing_strategy,pdf_path):
             "subject": metadata.get("Subject", "Unknown"),
         }
         
-        # Extract data page by page
-        for page_number in range(len(pdf)):
-            page = pdf[page_number]
-            
-            # Extract text
-            text = page.get_textpage().get_text_range()
-            
+        n_pages = len(pdf)
+        if n_pages >= PDF_PROCESS_POOL_MIN_PAGES:
+            # Large PDFs: extract page ranges in worker processes so the GIL stays free
+            pdf.close()
+            page_ranges = [(pdf_path, start, min(start + PDF_PAGES_PER_TASK, n_pages))
+                           for start in range(0, n_pages, PDF_PAGES_PER_TASK)]
+            page_texts = [text for texts in get_pdf_process_pool().map(extract_pdfium_page_range, page_ranges)
+                          for text in texts]
+        else:
+            page_texts = [pdf[page_number].get_textpage().get_text_range() for page_number in range(n_pages)]
+
+        # Build one document per page
+        for page_number, text in enumerate(page_texts):
             # Create metadata for the current page
             page_metadata = {
                 "page_number": page_number + 1,
@@ -268,29 +357,53 @@ def PARSING_PDF(parsing_strategy,pdf_path):
     
     
     elif parsing_strategy=="docling":
+        # Optional dependency, only imported when this strategy is used
+        from docling.document_converter import DocumentConverter
         
         converter = DocumentConverter()
         result = converter.convert(pdf_path)
         
         
         return result.document
+
+    else:
+        raise ValueError(f"Unknown parsing strategy: {parsing_strategy}")
+
+    return langchain_docs
     
 def load_and_split_documents(file_path:str)->list[Document]:
     if file_path.lower().endswith(".pdf"):
         # 1) Try text-based extraction first (fast)
         langchain_docs = PARSING_PDF("pdfium", file_path)
 
-        # 2) If scanned/empty → Vision extraction
-        if is_text_poor(langchain_docs):
-            parsed_json = parse_scanned_pdf_with_vision(file_path)
-            retrieval_text = json_to_retrieval_text(parsed_json)
-
-            langchain_docs = [
-                Document(
-                    page_content=retrieval_text,
-                    metadata={"source": file_path, "file_type": "pdf_scanned"}
-                )
-            ]
+        # 2) Scanned/empty pages only → Vision extraction, merged back in page order
+        poor_pages = [d.metadata["page_number"] for d in langchain_docs
+                      if is_text_poor([d], min_chars=MIN_PAGE_TEXT_CHARS)]
+        vision_pages = {}
+        if poor_pages:
+            parsed_json = parse_scanned_pdf_with_vision(file_path, page_numbers=poor_pages)
+            vision_pages = {page_obj["page"]: page_obj for page_obj in parsed_json["pages"]}
+
+        for doc in langchain_docs:
+            page_obj = vision_pages.get(doc.metadata["page_number"])
+            if page_obj is None:
+                doc.metadata["file_type"] = "pdf_text"
+                continue
+            if "error" in page_obj["result"]:
+                # Keep whatever text layer the page had; callers report these pages
+                doc.metadata["file_type"] = "pdf_scanned"
+                doc.metadata["vision_error"] = page_obj["result"]["error"]
+                continue
+
+            doc.page_content = json_to_retrieval_text({
+                "document_type": "Scanned PDF Form",
+                "pages": [page_obj]
+            })
+            doc.metadata["file_type"] = "pdf_scanned"
+            if "payload" in page_obj:
+                doc.metadata["payload_bytes_before"] = page_obj["payload"]["bytes_before"]
+                doc.metadata["payload_bytes_after"] = page_obj["payload"]["bytes_after"]
+                doc.metadata["payload_render_dpi"] = page_obj["payload"]["dpi"]
 
     elif file_path.lower().endswith(".docx"):
         loader=Docx2txtLoader(file_path)
@@ -300,7 +413,12 @@ def load_and_split_documents(file_path:str)->list[Document]:
         langchain_docs = loader.load()
     #jpg,png,tiff 
     elif file_path.lower().endswith((".jpg", ".jpeg", ".png", ".tiff", ".tif")):
-        parsed = parsing_image(file_path)
+        with open(file_path, "rb") as f:
+            image_bytes = f.read()
+        image_bytes, mime, payload = preprocess_image_bytes(image_bytes, guess_mime(file_path))
+        log_payload(file_path, payload)
+
+        parsed = parsing_image_bytes(image_bytes, mime)
         retrieval_text = json_to_retrieval_text({
             "document_type": "Image Form",
             "pages": [{"page": 1, "result": parsed}]
@@ -309,7 +427,9 @@ def load_and_split_documents(file_path:str)->list[Document]:
         langchain_docs = [
             Document(
                 page_content=retrieval_text,
-                metadata={"source": file_path, "file_type": "image"}
+                metadata={"source": file_path, "file_type": "image",
+                          "payload_bytes_before": payload["bytes_before"],
+                          "payload_bytes_after": payload["bytes_after"]}
             )
         ]
 
@@ -0,0 +1,16 @@
+import pypdfium2 as pdfium
+
+# Code run in the PDF process pool. Workers are spawned and import only this module,
+# so keep it free of the parsing stack (langchain, openai, fitz, caches).
+
+
+def extract_pdfium_page_range(args) -> list[str]:
+    """
+    Extract text for pages [start, end) of a PDF. Runs in a worker process.
+    """
+    pdf_path, start, end = args
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return [pdf[page_number].get_textpage().get_text_range() for page_number in range(start, end)]
+    finally:
+        pdf.close()
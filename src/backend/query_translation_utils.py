@@ -1,16 +1,134 @@
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from typing import List
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from typing import List, Optional, Tuple
+import threading
 from langchain_core.documents import Document
 import os
-from vector_db_utils import vectorstore
+from vector_db_utils import search_chunks
+from lexical_index_utils import lexical_index, tokenize
+from openai_client_utils import get_chat_model
+from cache_utils import SemanticAnswerCache
 from langchain.prompts import ChatPromptTemplate
 from langchain.chains import LLMChain
 from langchain_openai import ChatOpenAI
-retriever = vectorstore.as_retriever(search_kwargs={"k": 2})
+
+# "vector", "lexical", "hybrid" (BM25 + vector fused with RRF) or "auto",
+# which answers exact-token lookups from the lexical index alone
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "auto")
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid", "auto")
+RRF_K = 60
+# Candidates taken from each retriever before fusion, per requested result
+FUSION_CANDIDATES_PER_RESULT = 4
+
+
+def reciprocal_rank_fusion(results: List[List[Document]], k: int = RRF_K) -> List[Tuple[Document, float]]:
+    """
+    Fuse several ranked lists of documents with the RRF formula 1 / (rank + k).
+    Documents are matched across lists by chunk id. Returns (document, score) pairs, best first.
+    """
+    fused_scores = {}
+    documents = {}
+    for docs in results:
+        for rank, doc in enumerate(docs):
+            key = doc.id or doc.page_content
+            documents.setdefault(key, doc)
+            fused_scores[key] = fused_scores.get(key, 0) + 1 / (rank + k)
+
+    return [(documents[key], score) for key, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)]
+
+
+def is_lexical_query(query: str) -> bool:
+    """
+    Exact-token lookups: a quoted string, or a query made only of identifier-like tokens
+    such as policy IDs, phone numbers and dates.
+    """
+    query = query.strip()
+    if len(query) > 2 and query[0] == query[-1] == '"':
+        return True
+    tokens = query.split()
+    return bool(tokens) and all(any(c.isdigit() for c in token) for token in tokens)
+
+
+def question_identifiers(question: str) -> frozenset:
+    """
+    Identifier tokens of a question (lexical index terms containing a digit).
+    """
+    return frozenset(term for term in tokenize(question) if any(c.isdigit() for c in term))
+
+
+def hybrid_search(query: str, file_ids: Optional[List[int]] = None, k: int = 4, mode: str = RETRIEVAL_MODE) -> List[Document]:
+    """
+    Top-k chunks for a query, optionally restricted to file_ids. See RETRIEVAL_MODE for the modes;
+    the lexical side never calls the embedding model.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+    n_candidates = k * FUSION_CANDIDATES_PER_RESULT
+
+    lexical_docs = []
+    if mode != "vector":
+        lexical_docs = [doc for doc, _ in lexical_index.search(query, file_ids=file_ids, k=n_candidates)]
+    if mode == "lexical" or (mode == "auto" and lexical_docs and is_lexical_query(query)):
+        return lexical_docs[:k]
+
+    vector_docs = search_chunks(query, file_ids=file_ids, k=n_candidates if lexical_docs else k)
+    if mode == "vector" or not lexical_docs:
+        return vector_docs[:k]
+
+    return [doc for doc, _ in reciprocal_rank_fusion([lexical_docs, vector_docs])[:k]]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever over the whole corpus that combines the BM25 lexical index with vector search.
+    """
+    k: int = 4
+    mode: str = RETRIEVAL_MODE
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return hybrid_search(query, k=self.k, mode=self.mode)
+
+
+retriever = HybridRetriever(k=2)
+
+# Answers to repeat questions, matched on the standalone question; 0 entries disables it
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.95"))
+answer_cache = None
+if ANSWER_CACHE_MAX_ENTRIES > 0:
+    answer_cache = SemanticAnswerCache(os.getenv("ANSWER_CACHE_PATH", "answer_cache.db"),
+                                       ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MIN_SIMILARITY, question_identifiers)
+
+# Process-wide registry of built chains keyed by (chain name, parameters). Chains are
+# stateless runnables, so one instance per key serves every request.
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def _get_or_build_chain(name: str, build, **params):
+    key = (name, tuple(sorted(params.items())))
+    with _chains_lock:
+        chain = _chains.get(key)
+        if chain is None:
+            chain = build(**params)
+            _chains[key] = chain
+    return chain
+
+
+def prebuild_chains(models: List[str]):
+    """
+    Build every chain for the given models up front, e.g. at startup.
+    """
+    for model in models:
+        get_question_rewriter(model)
+        get_answer_chain(model)
+        get_summarization_chain(model)
+        get_field_extraction_chain(model)
+        get_insights_chain(model)
 
 output_parser = StrOutputParser()
 
@@ -43,12 +161,29 @@ qa_prompt = ChatPromptTemplate.from_messages([
 
 
 
-def get_rag_chain(model="gpt-4o-mini"):
-    llm = ChatOpenAI(model=model)
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)    
-    return rag_chain
+def get_question_rewriter(model="gpt-4o-mini"):
+    return _get_or_build_chain("question_rewriter", _build_question_rewriter, model=model)
+
+def _build_question_rewriter(model):
+    return contextualize_q_prompt | get_chat_model(model) | StrOutputParser()
+
+def get_answer_chain(model="gpt-4o-mini"):
+    """
+    Answers {"input", "chat_history", "context"} from already retrieved documents.
+    """
+    return _get_or_build_chain("answer", _build_answer_chain, model=model)
+
+def _build_answer_chain(model):
+    return create_stuff_documents_chain(get_chat_model(model), qa_prompt)
+
+def rewrite_question(question: str, chat_history: list, model: str = "gpt-4o-mini") -> str:
+    """
+    Standalone form of the question, as the history-aware retriever would search for it.
+    Without chat history the question is used as is, with no LLM call.
+    """
+    if not chat_history:
+        return question
+    return get_question_rewriter(model).invoke({"input": question, "chat_history": chat_history})
 
 
 
@@ -59,7 +194,10 @@ from langchain.prompts import ChatPromptTemplate
 from langchain.chains import LLMChain
 
 def get_summarization_chain(model="gpt-4o-mini"):
-    llm = ChatOpenAI(model=model, temperature=0)
+    return _get_or_build_chain("summarization", _build_summarization_chain, model=model)
+
+def _build_summarization_chain(model):
+    llm = get_chat_model(model, temperature=0)
 
     summarization_prompt = ChatPromptTemplate.from_messages([
         ("system",
@@ -79,11 +217,13 @@ def get_summarization_chain(model="gpt-4o-mini"):
         )
     ])
 
-    print("Summarization prompt variables:", summarization_prompt.input_variables)
     return LLMChain(llm=llm, prompt=summarization_prompt)
 
 def get_field_extraction_chain(model="gpt-4o-mini"):
-    llm = ChatOpenAI(model=model, temperature=0)
+    return _get_or_build_chain("field_extraction", _build_field_extraction_chain, model=model)
+
+def _build_field_extraction_chain(model):
+    llm = get_chat_model(model, temperature=0)
 
     prompt = ChatPromptTemplate.from_messages([
         ("system",
@@ -96,6 +236,32 @@ def get_field_extraction_chain(model="gpt-4o-mini"):
 
     return prompt | llm
 
+def get_insights_chain(model="gpt-4o-mini"):
+    return _get_or_build_chain("insights", _build_insights_chain, model=model)
+
+def _build_insights_chain(model):
+    llm = get_chat_model(model, temperature=0)
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system",
+        "You are an Intelligent Form Agent. Answer using ONLY the provided document contexts. "
+        "Do not guess. If info is missing, say 'Not Found'. "
+        "Return ONLY valid JSON (no markdown)."
+        ),
+        ("human",
+        "Question: {question}\n\n"
+        "Document Contexts:\n{context}\n\n"
+        "Return JSON with these keys exactly:\n"
+        "answer, per_document, stats, recommendations.\n\n"
+        "Rules:\n"
+        "- per_document must be a list of objects with keys: file_id and finding\n"
+        "- stats must be a JSON object (can be empty)\n"
+        "- recommendations must be a list\n"
+        )
+    ])
+
+    return LLMChain(llm=llm, prompt=prompt)
+
 # import os
 # import yaml 
 # from langchain_core.prompts import ChatPromptTemplate
@@ -252,35 +418,6 @@ def get_field_extraction_chain(model="gpt-4o-mini"):
 # #########################################################################################
 
 
-# def reciprocal_rank_fusion(results: list[list], k=60):
-#                 """ Reciprocal_rank_fusion that takes multiple lists of ranked documents 
-#                     and an optional parameter k used in the RRF formula """
-                
-#                 # Initialize a dictionary to hold fused scores for each unique document
-#                 fused_scores = {}
-
-#                 # Iterate through each list of ranked documents
-#                 for docs in results:
-#                     # Iterate through each document in the list, with its rank (position in the list)
-#                     for rank, doc in enumerate(docs):
-#                         # Convert the document to a string format to use as a key (assumes documents can be serialized to JSON)
-#                         doc_str = dumps(doc)
-#                         # If the document is not yet in the fused_scores dictionary, add it with an initial score of 0
-#                         if doc_str not in fused_scores:
-#                             fused_scores[doc_str] = 0
-#                         # Retrieve the current score of the document, if any
-#                         previous_score = fused_scores[doc_str]
-#                         # Update the score of the document using the RRF formula: 1 / (rank + k)
-#                         fused_scores[doc_str] += 1 / (rank + k)
-
-#                 # Sort the documents based on their fused scores in descending order to get the final reranked results
-#                 reranked_results = [
-#                     (loads(doc), score)
-#                     for doc, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
-#                 ]
-
-#                 # Return the reranked results as a list of tuples, each containing the document and its fused score
-#                 return reranked_results
             
 # ################################# decomposition ################################################################################3
 
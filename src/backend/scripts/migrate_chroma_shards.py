@@ -0,0 +1,92 @@
+"""
+Move the chunks in chroma_db from one shard layout to another.
+
+Chunks are copied with their stored embeddings (nothing is re-embedded) into the
+collections of the target layout, routed by file_id exactly as vector_db_utils does.
+Copies are upserts, so an interrupted run can simply be repeated. The source
+collections are only dropped with --delete-source, after the counts are verified.
+
+Usage (from src/backend, with the API stopped):
+    python scripts/migrate_chroma_shards.py --to-shards 8
+    python scripts/migrate_chroma_shards.py --to-shards 8 --delete-source
+    CHROMA_SHARDS=8 python scripts/migrate_chroma_shards.py --to-shards 1   # back to one collection
+"""
+import os
+import sys
+import argparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import chromadb
+from chroma_shard_utils import CHROMA_PERSIST_DIRECTORY, CHROMA_SHARDS, shard_collection_name, shard_for
+
+
+def migrate(client, from_shards: int, to_shards: int, batch_size: int, delete_source: bool):
+    existing = {collection.name for collection in client.list_collections()}
+    source_names = [shard_collection_name(shard, from_shards) for shard in range(from_shards)]
+    source_names = [name for name in source_names if name in existing]
+    if not source_names:
+        sys.exit(f"No collections of the {from_shards}-shard layout found")
+
+    first_source = client.get_collection(source_names[0])
+    # Keep the source distance metric (and any other collection settings)
+    targets = [client.get_or_create_collection(shard_collection_name(shard, to_shards), metadata=first_source.metadata)
+               for shard in range(to_shards)]
+
+    copied = 0
+    source_total = 0
+    for name in source_names:
+        source = client.get_collection(name)
+        source_count = source.count()
+        source_total += source_count
+        offset = 0
+        while True:
+            results = source.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+            if not results["ids"]:
+                break
+
+            by_shard = {}
+            for i, metadata in enumerate(results["metadatas"]):
+                by_shard.setdefault(shard_for((metadata or {}).get("file_id"), to_shards), []).append(i)
+            for shard, indices in by_shard.items():
+                targets[shard].upsert(
+                    ids=[results["ids"][i] for i in indices],
+                    embeddings=[results["embeddings"][i] for i in indices],
+                    documents=[results["documents"][i] for i in indices],
+                    metadatas=[results["metadatas"][i] for i in indices],
+                )
+            copied += len(results["ids"])
+            offset += batch_size
+            print(f"{name}: copied {min(offset, source_count)}/{source_count}", file=sys.stderr)
+
+    target_total = sum(target.count() for target in targets)
+    print(f"Copied {copied} chunks from {len(source_names)} collection(s) into {to_shards}; "
+          f"target layout now holds {target_total}", file=sys.stderr)
+    if target_total < source_total:
+        sys.exit("Target layout holds fewer chunks than the source; leaving the source in place")
+
+    if delete_source:
+        for name in source_names:
+            client.delete_collection(name)
+        print(f"Deleted source collections: {', '.join(source_names)}", file=sys.stderr)
+    print(f"Start the API with CHROMA_SHARDS={to_shards} to use the new layout.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--persist-directory", default=CHROMA_PERSIST_DIRECTORY)
+    parser.add_argument("--from-shards", type=int, default=CHROMA_SHARDS, help="current layout (default: CHROMA_SHARDS)")
+    parser.add_argument("--to-shards", type=int, required=True, help="target number of shards")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--delete-source", action="store_true", help="drop the source collections after a verified copy")
+    args = parser.parse_args()
+
+    if args.from_shards == args.to_shards:
+        sys.exit("Source and target layouts are the same")
+    client = chromadb.PersistentClient(path=args.persist_directory)
+    migrate(client, args.from_shards, args.to_shards, args.batch_size, args.delete_source)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,133 @@ from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, Un
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_chroma import Chroma
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from langchain_core.documents import Document
 import os
+import time
+import threading
+import tiktoken
+import chromadb
+from concurrent.futures import ThreadPoolExecutor
 from parsing_utils import load_and_split_documents
 from chunking_utils import CHUNKING_STRATEGY
+from cache_utils import SQLiteLRUCache, CachedEmbeddings, FileVectorCache, sha256_hex
+from lexical_index_utils import lexical_index
+from openai_client_utils import http_client, async_http_client
+from chroma_shard_utils import (CHROMA_PERSIST_DIRECTORY, CHROMA_SHARDS, shard_collection_name,
+                                shard_for, group_by_shard)
 from dotenv import load_dotenv
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len)
-embedding_function = OpenAIEmbeddings(api_key=api_key)
-vectorstore = Chroma(persist_directory="./chroma_db", embedding_function=embedding_function)
+# Chunk and query embeddings are cached on disk, so unchanged text is never re-embedded
+embedding_function = CachedEmbeddings(
+    OpenAIEmbeddings(api_key=api_key, http_client=http_client, http_async_client=async_http_client),
+    SQLiteLRUCache(
+        os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db"),
+        max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+    ),
+)
+# Chunks are hash-partitioned by file_id over CHROMA_SHARDS collections (one by default).
+# File-scoped calls go to one shard; cross-document calls fan out over the shards in parallel.
+chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+shards = [Chroma(client=chroma_client, collection_name=shard_collection_name(shard), embedding_function=embedding_function)
+          for shard in range(CHROMA_SHARDS)]
+shard_executor = ThreadPoolExecutor(max_workers=CHROMA_SHARDS, thread_name_prefix="chroma-shard")
+
+# Optional in-memory per-file vector matrices for file-scoped search; 0 disables it
+FLAT_INDEX_MAX_MB = int(os.getenv("FLAT_INDEX_MAX_MB", "256"))
+flat_index = FileVectorCache(FLAT_INDEX_MAX_MB * 1024 * 1024) if FLAT_INDEX_MAX_MB > 0 else None
+
+# "form" keeps field/value lines and sections intact; see chunking_utils for the others
+CHUNKING_STRATEGY_NAME = os.getenv("CHUNKING_STRATEGY", "form")
+
+# Embedding stage sizing: token budget and input count per request, batches in flight,
+# and how many chunks are written to Chroma per call
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "1000"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+CHROMA_WRITE_BATCH = int(os.getenv("CHROMA_WRITE_BATCH", "500"))
+
+# file_id -> number of chunks stored in Chroma. Set when a document is written,
+# filled lazily from a metadata-only fetch for documents indexed by an earlier process.
+_chunk_counts = {}
+_chunk_counts_lock = threading.Lock()
+
+_tokenizer = None
+
+def count_tokens(text: str) -> int:
+    """
+    Token count used for embedding batch packing. The tiktoken encoding is loaded on
+    first use; if it cannot be loaded (e.g. offline), fall back to ~4 chars per token.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            _tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Could not load tiktoken encoding, estimating token counts: {e}")
+            _tokenizer = False
+    if _tokenizer is False:
+        return len(text) // 4 + 1
+    return len(_tokenizer.encode(text, disallowed_special=()))
+
+def pack_embedding_batches(texts: List[str], max_tokens: int = EMBEDDING_BATCH_TOKENS,
+                           max_size: int = EMBEDDING_BATCH_SIZE) -> List[List[int]]:
+    """
+    Greedily pack text indices into batches that stay under max_tokens and max_size.
+    A single text larger than max_tokens gets a batch of its own.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        n_tokens = count_tokens(text)
+        if current and (current_tokens + n_tokens > max_tokens or len(current) >= max_size):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def embed_texts(texts: List[str], max_concurrency: int = EMBEDDING_CONCURRENCY) -> List[List[float]]:
+    """
+    Embed texts in token-bounded batches, with up to max_concurrency batches in flight.
+    Vectors are returned in input order.
+    """
+    batches = pack_embedding_batches(texts)
+    if not batches:
+        return []
+
+    def embed_batch(indices):
+        return embedding_function.embed_documents([texts[i] for i in indices])
+
+    vectors = [None] * len(texts)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches))), thread_name_prefix="embedding") as pool:
+        for indices, batch_vectors in zip(batches, pool.map(embed_batch, batches)):
+            for i, vector in zip(indices, batch_vectors):
+                vectors[i] = vector
+    return vectors
+
+def write_chunks_to_chroma(splits: List[Document], vectors: List[List[float]], batch_size: int = CHROMA_WRITE_BATCH):
+    """
+    Write chunks with precomputed embeddings to Chroma in bounded-size batches.
+    Chunk ids come from assign_chunk_ids, so rewriting the same chunk is an idempotent upsert.
+    """
+    by_shard = {}
+    for split, vector in zip(splits, vectors):
+        by_shard.setdefault(shard_for(split.metadata["file_id"]), []).append((split, vector))
+
+    for shard, items in by_shard.items():
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            shards[shard]._collection.upsert(
+                ids=[split.metadata["chunk_id"] for split, _ in batch],
+                embeddings=[vector for _, vector in batch],
+                documents=[split.page_content for split, _ in batch],
+                metadatas=[split.metadata for split, _ in batch],
+            )
 
 # def load_and_split_document(file_path: str) -> List[Document]:
 #     if file_path.endswith('.pdf'):
@@ -27,51 +143,441 @@ vectorstore = Chroma(persist_directory="./chroma_db", embedding_function=embeddi
 #     documents = loader.load()
 #     return text_splitter.split_documents(documents)
 
-def index_document_to_chroma(file_path: str, file_id: int) -> bool:
+def assign_chunk_ids(splits: List[Document], file_id: int):
+    """
+    Tag chunks with file_id, their position and a content-derived id.
+    The id is "<file_id>:<sha256 of text>:<n>", n counting repeats of the same text,
+    so an unchanged chunk keeps its id across re-parses of a new file version.
+    """
+    seen = {}
+    for index, split in enumerate(splits):
+        chunk_hash = sha256_hex(split.page_content)
+        occurrence = seen.get(chunk_hash, 0)
+        seen[chunk_hash] = occurrence + 1
+
+        split.metadata['file_id'] = file_id
+        split.metadata['chunk_index'] = index
+        split.metadata['chunk_hash'] = chunk_hash
+        split.metadata['chunk_id'] = f"{file_id}:{chunk_hash}:{occurrence}"
+
+def build_chunks(file_path: str, file_id: int, report) -> Tuple[List[Document], Dict[str, List[float]]]:
+    """
+    Returns the chunks and any vectors the splitter derived for them (chunk text -> vector).
+    """
+    report("parsing")
+    langchain_docs = load_and_split_documents(file_path)
+
+    failed_pages = [doc.metadata["page_number"] for doc in langchain_docs if "vision_error" in doc.metadata]
+    report("chunking", pages=len(langchain_docs), failed_pages=failed_pages)
+    if failed_pages and len(failed_pages) == len(langchain_docs):
+        raise ValueError(f"Vision extraction failed for every page of {file_path}")
+    text_splitter = CHUNKING_STRATEGY(CHUNKING_STRATEGY_NAME, embeddings=embedding_function)
+    splits = text_splitter.split_documents(langchain_docs)
+    print(f"Number of splits created: {len(splits)}")
+
+    assign_chunk_ids(splits, file_id)
+    return splits, getattr(text_splitter, "chunk_vectors", {})
+
+def embed_and_write_chunks(splits: List[Document], report, precomputed: Dict[str, List[float]] = None):
+    """
+    precomputed (chunk text -> vector) is used as is for those chunks and never cached as
+    model output; only the remaining chunks are embedded.
+    """
+    report("embedding", chunks=len(splits))
+    start_time = time.perf_counter()
+    precomputed = precomputed or {}
+    missing = [split.page_content for split in splits if split.page_content not in precomputed]
+    embedded = dict(zip(missing, embed_texts(missing)))
+    vectors = [precomputed.get(split.page_content) or embedded[split.page_content] for split in splits]
+
+    report("writing", chunks=len(splits))
+    write_chunks_to_chroma(splits, vectors)
+    lexical_index.add_chunks([split.metadata["chunk_id"] for split in splits], splits)
+    # vectorstore.persist()
+
+    elapsed = time.perf_counter() - start_time
+    chunks_per_sec = round(len(splits) / elapsed, 2) if elapsed > 0 else None
+    print(f"Embedded and stored {len(splits)} chunks in {elapsed:.2f}s ({chunks_per_sec} chunks/sec)")
+    report("indexed", chunks=len(splits), seconds=round(elapsed, 3), chunks_per_sec=chunks_per_sec)
+
+def _reporter(progress_callback):
+    def report(stage, **details):
+        if progress_callback:
+            progress_callback(stage, **details)
+    return report
+
+def index_document_to_chroma(file_path: str, file_id: int, progress_callback=None) -> bool:
+    """
+    Parse, chunk and embed a document into Chroma.
+    progress_callback(stage, **details) is called as each stage starts, if given.
+    """
+    report = _reporter(progress_callback)
     try:
-        langchain_docs = load_and_split_documents(file_path)
-        text_splitter = CHUNKING_STRATEGY("RecursiveCharacterTextSplitter")
-        splits = text_splitter.split_documents(langchain_docs)
-        print(f"Number of splits created: {len(splits)}")
-        
-        
-        # Add metadata to each split
-        for split in splits:
-            split.metadata['file_id'] = file_id
-        
-        vectorstore.add_documents(splits)
-        # vectorstore.persist()
+        splits, precomputed = build_chunks(file_path, file_id, report)
+        embed_and_write_chunks(splits, report, precomputed)
+        set_chunk_count(file_id, len(splits))
+        invalidate_flat_index(file_id)
         return True
     except Exception as e:
         print(f"Error indexing document: {e}")
+        forget_chunk_count(file_id)
+        invalidate_flat_index(file_id)
         return False
 
-def delete_doc_from_chroma(file_id: int):
+def update_document_in_chroma(file_path: str, file_id: int, progress_callback=None) -> bool:
+    """
+    Re-index a new version of an already indexed document by diffing chunk ids.
+    Only added or changed chunks are embedded and upserted, vanished chunks are deleted,
+    and unchanged chunks only get their position metadata refreshed.
+    If any write fails, the previous version is restored before returning False.
+    """
+    report = _reporter(progress_callback)
     try:
-        docs = vectorstore.get(where={"file_id": file_id})
-        print(f"Found {len(docs['ids'])} document chunks for file_id {file_id}")
-        
-        vectorstore._collection.delete(where={"file_id": file_id})
-        print(f"Deleted all documents with file_id {file_id}")
-        
+        splits, precomputed = build_chunks(file_path, file_id, report)
+        collection = _collection_for(file_id)
+
+        existing = collection.get(where={"file_id": file_id}, include=["metadatas"])
+        previous_metadata = dict(zip(existing["ids"], existing["metadatas"]))
+        new_ids = {split.metadata["chunk_id"] for split in splits}
+        added = [split for split in splits if split.metadata["chunk_id"] not in previous_metadata]
+        unchanged = [split for split in splits if split.metadata["chunk_id"] in previous_metadata]
+        removed_ids = [chunk_id for chunk_id in previous_metadata if chunk_id not in new_ids]
+        report("diff", added=len(added), removed=len(removed_ids), unchanged=len(unchanged))
+
+        # Everything needed to put the previous version back, taken before the first write
+        removed = collection.get(ids=removed_ids, include=["embeddings", "documents", "metadatas"]) if removed_ids else None
+        try:
+            if added:
+                embed_and_write_chunks(added, report, precomputed)
+            for start in range(0, len(unchanged), CHROMA_WRITE_BATCH):
+                batch = unchanged[start:start + CHROMA_WRITE_BATCH]
+                collection.update(
+                    ids=[split.metadata["chunk_id"] for split in batch],
+                    metadatas=[split.metadata for split in batch],
+                )
+            for start in range(0, len(removed_ids), CHROMA_WRITE_BATCH):
+                collection.delete(ids=removed_ids[start:start + CHROMA_WRITE_BATCH])
+            # Tokenizing is cheap, so unchanged chunks are simply re-indexed with their new positions
+            lexical_index.add_chunks([split.metadata["chunk_id"] for split in unchanged], unchanged)
+            lexical_index.delete_chunks(removed_ids)
+        except Exception:
+            _restore_previous_version(collection, added, unchanged, previous_metadata, removed)
+            raise
+
+        set_chunk_count(file_id, len(splits))
+        invalidate_flat_index(file_id)
+        print(f"Updated file_id {file_id}: {len(added)} added, {len(removed_ids)} removed, {len(unchanged)} unchanged")
         return True
     except Exception as e:
-        print(f"Error deleting document with file_id {file_id} from Chroma: {str(e)}")
+        print(f"Error updating document with file_id {file_id}: {e}")
+        forget_chunk_count(file_id)
+        invalidate_flat_index(file_id)
         return False
+
+def _restore_previous_version(collection, added: List[Document], unchanged: List[Document],
+                              previous_metadata: Dict[str, dict], removed: Optional[dict]):
+    """
+    Undo a partially applied update: drop the added chunks, put back the old metadata of
+    unchanged chunks and re-insert the removed ones. Every step is idempotent.
+    """
+    added_ids = [split.metadata["chunk_id"] for split in added]
+    for start in range(0, len(added_ids), CHROMA_WRITE_BATCH):
+        collection.delete(ids=added_ids[start:start + CHROMA_WRITE_BATCH])
+    lexical_index.delete_chunks(added_ids)
+
+    unchanged_ids = [split.metadata["chunk_id"] for split in unchanged]
+    for start in range(0, len(unchanged_ids), CHROMA_WRITE_BATCH):
+        batch = unchanged_ids[start:start + CHROMA_WRITE_BATCH]
+        collection.update(ids=batch, metadatas=[previous_metadata[chunk_id] for chunk_id in batch])
+    lexical_index.add_chunks(unchanged_ids, [Document(page_content=split.page_content, metadata=previous_metadata[split.metadata["chunk_id"]])
+                                             for split in unchanged])
+
+    if removed is not None:
+        for start in range(0, len(removed["ids"]), CHROMA_WRITE_BATCH):
+            end = start + CHROMA_WRITE_BATCH
+            collection.upsert(ids=removed["ids"][start:end], embeddings=removed["embeddings"][start:end],
+                              documents=removed["documents"][start:end], metadatas=removed["metadatas"][start:end])
+        lexical_index.add_chunks(removed["ids"], [Document(page_content=document, metadata=metadata)
+                                                  for document, metadata in zip(removed["documents"], removed["metadatas"])])
+    print(f"Restored the previous version: removed {len(added_ids)} added chunks")
+
+def _collection_for(file_id: int):
+    return shards[shard_for(file_id)]._collection
+
+def _fan_out(fn, file_ids: Optional[List[int]]) -> list:
+    """
+    Calls fn(collection, shard_file_ids) on every shard holding any of file_ids
+    (all shards for None), in parallel when more than one shard is involved.
+    """
+    groups = list(group_by_shard(file_ids).items())
+    if len(groups) == 1:
+        shard, shard_file_ids = groups[0]
+        return [fn(shards[shard]._collection, shard_file_ids)]
+    return list(shard_executor.map(lambda group: fn(shards[group[0]]._collection, group[1]), groups))
+
+def set_chunk_count(file_id: int, count: int):
+    with _chunk_counts_lock:
+        _chunk_counts[file_id] = count
+
+def forget_chunk_count(file_id: int):
+    with _chunk_counts_lock:
+        _chunk_counts.pop(file_id, None)
+
+def _file_filter(file_ids: Optional[List[int]]) -> Optional[dict]:
+    if file_ids is None:
+        return None
+    return {"file_id": {"$in": list(file_ids)}} if len(file_ids) > 1 else {"file_id": file_ids[0]}
+
+def get_chunk_counts(file_ids: List[int]) -> Dict[int, int]:
+    """
+    Returns {file_id: chunk count}. Unknown files are counted from their metadata in one fetch per shard.
+    """
+    with _chunk_counts_lock:
+        counts = {file_id: _chunk_counts[file_id] for file_id in file_ids if file_id in _chunk_counts}
+    missing = [file_id for file_id in file_ids if file_id not in counts]
+    if missing:
+        fetched = {file_id: 0 for file_id in missing}
+        shard_metadatas = _fan_out(
+            lambda collection, shard_file_ids: collection.get(where=_file_filter(shard_file_ids), include=["metadatas"])["metadatas"],
+            missing)
+        for metadatas in shard_metadatas:
+            for metadata in metadatas:
+                file_id = (metadata or {}).get("file_id")
+                if file_id in fetched:
+                    fetched[file_id] += 1
+        for file_id, count in fetched.items():
+            set_chunk_count(file_id, count)
+        counts.update(fetched)
+    return counts
+
+def get_all_chunks(file_ids: List[int]) -> Dict[int, List[Document]]:
+    """
+    Returns {file_id: every chunk of the file in document order}, without any embedding call.
+    """
+    grouped = {file_id: [] for file_id in file_ids}
+    if not file_ids:
+        return grouped
+    shard_results = _fan_out(
+        lambda collection, shard_file_ids: collection.get(where=_file_filter(shard_file_ids), include=["documents", "metadatas"]),
+        file_ids)
+    for results in shard_results:
+        for chunk_id, text, metadata in zip(results["ids"], results["documents"], results["metadatas"]):
+            metadata = metadata or {}
+            if metadata.get("file_id") in grouped:
+                grouped[metadata["file_id"]].append(Document(page_content=text, metadata=metadata, id=chunk_id))
+    for docs in grouped.values():
+        docs.sort(key=lambda doc: doc.metadata.get("chunk_index", 0))
+    return grouped
+
+def _small_file_chunks(file_ids: List[int], k: int) -> Dict[int, List[Document]]:
+    """
+    Returns all chunks of the files that have at most k chunks; a top-k search over
+    those would return the whole document anyway. Other files are left out.
+    """
+    counts = get_chunk_counts(file_ids)
+    small = [file_id for file_id in file_ids if counts[file_id] <= k]
+    found = {}
+    for file_id, docs in get_all_chunks(small).items():
+        # The count can be stale if another process re-indexed the file
+        set_chunk_count(file_id, len(docs))
+        if len(docs) <= k:
+            found[file_id] = docs
+    return found
+
+def invalidate_flat_index(file_id: int):
+    if flat_index is not None:
+        flat_index.invalidate(file_id)
+
+def _flat_index_entries(file_ids: List[int]) -> dict:
+    """
+    Returns {file_id: flat index entry}, loading the vectors of files that are not
+    cached yet with one Chroma fetch per shard. Empty when the flat index is disabled.
+    """
+    if flat_index is None or not file_ids:
+        return {}
+    entries = {}
+    missing = []
+    for file_id in file_ids:
+        entry = flat_index.get(file_id)
+        if entry is None:
+            missing.append(file_id)
+        else:
+            entries[file_id] = entry
+    if missing:
+        # A write that invalidates a file during the fetch makes its put a no-op
+        generations = {file_id: flat_index.generation(file_id) for file_id in missing}
+        shard_results = _fan_out(
+            lambda collection, shard_file_ids: collection.get(where=_file_filter(shard_file_ids),
+                                                              include=["embeddings", "documents", "metadatas"]),
+            missing)
+        vectors = {file_id: [] for file_id in missing}
+        docs = {file_id: [] for file_id in missing}
+        for results in shard_results:
+            for chunk_id, vector, text, metadata in zip(results["ids"], results["embeddings"],
+                                                        results["documents"], results["metadatas"]):
+                metadata = metadata or {}
+                if metadata.get("file_id") in docs:
+                    vectors[metadata["file_id"]].append(vector)
+                    docs[metadata["file_id"]].append(Document(page_content=text, metadata=metadata, id=chunk_id))
+        for file_id in missing:
+            entries[file_id] = flat_index.put(file_id, vectors[file_id], docs[file_id], generations[file_id])
+    return entries
+
+def backfill_lexical_index(batch_size: int = CHROMA_WRITE_BATCH):
+    """
+    Build the lexical index from the chunks already in Chroma, for stores indexed
+    before it existed. Does nothing once the lexical index has any chunks.
+    """
+    if lexical_index.count() > 0:
+        return
+    total = 0
+    for shard in shards:
+        offset = 0
+        while True:
+            results = shard._collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            if not results["ids"]:
+                break
+            docs = [Document(page_content=text, metadata=metadata or {})
+                    for text, metadata in zip(results["documents"], results["metadatas"])]
+            lexical_index.add_chunks(results["ids"], docs)
+            total += len(docs)
+            offset += batch_size
+    if total:
+        print(f"Backfilled the lexical index with {total} chunks")
+
+def delete_docs_from_chroma(file_ids: List[int]) -> bool:
+    """
+    Delete every chunk of the given files with one metadata-filtered delete per shard.
+    Nothing is read back first, so no chunk text or metadata is loaded.
+    """
+    if not file_ids:
+        return True
+    try:
+        _fan_out(lambda collection, shard_file_ids: collection.delete(where=_file_filter(shard_file_ids)), file_ids)
+        lexical_index.delete_files(file_ids)
+        for file_id in file_ids:
+            forget_chunk_count(file_id)
+            invalidate_flat_index(file_id)
+        print(f"Deleted all documents with file_ids {file_ids}")
+        return True
+    except Exception as e:
+        print(f"Error deleting documents with file_ids {file_ids} from Chroma: {str(e)}")
+        return False
+
+def delete_doc_from_chroma(file_id: int):
+    return delete_docs_from_chroma([file_id])
     
 def get_relevant_chunks_from_chroma(query: str, file_id: int, k: int = 8):
     """
     Returns top-k relevant chunks ONLY from the given file_id.
+    Documents with at most k chunks are returned whole, in document order.
     """
     try:
-        results = vectorstore.similarity_search(
-            query=query,
-            k=k,
-            filter={"file_id": file_id}   # IMPORTANT: restrict to one document
-        )
-        return results  # list[Document]
+        small = _small_file_chunks([file_id], k)
+        if file_id in small:
+            return small[file_id]
+        entries = _flat_index_entries([file_id])
+        if entries:
+            return flat_index.search(entries[file_id], [embedding_function.embed_query(query)], k)[0]
+        return search_chunks(query, file_ids=[file_id], k=k)  # IMPORTANT: restrict to one document
     except Exception as e:
         print(f"Error retrieving chunks from Chroma: {e}")
         return []
 
 
+def _query_chroma(query_vectors: List[List[float]], file_ids: Optional[List[int]], k: int) -> List[List[Document]]:
+    """
+    Top-k chunks for each query vector among file_ids (None searches every file).
+    Only the shards holding those files are queried; their hits are merged by distance.
+    """
+    def query_shard(collection, shard_file_ids):
+        results = collection.query(
+            query_embeddings=query_vectors,
+            n_results=k,
+            where=_file_filter(shard_file_ids),
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [(Document(page_content=text, metadata=metadata or {}, id=chunk_id), distance)
+             for chunk_id, text, metadata, distance in zip(ids, texts, metadatas, distances)]
+            for ids, texts, metadatas, distances in zip(results["ids"], results["documents"],
+                                                        results["metadatas"], results["distances"])
+        ]
+
+    shard_hits = _fan_out(query_shard, file_ids)
+    merged = []
+    for i in range(len(query_vectors)):
+        hits = sorted((hit for hits in shard_hits for hit in hits[i]), key=lambda hit: hit[1])
+        merged.append([doc for doc, _ in hits[:k]])
+    return merged
+
+def search_chunks(query: str, file_ids: Optional[List[int]] = None, k: int = 8) -> List[Document]:
+    """
+    Top-k chunks for a query by vector similarity, over file_ids or the whole corpus.
+    """
+    if file_ids == []:
+        return []
+    return _query_chroma([embedding_function.embed_query(query)], file_ids, k)[0]
+
+def get_relevant_chunks_for_queries(queries: List[str], file_id: int, k: int = 8) -> List[List[Document]]:
+    """
+    Returns top-k relevant chunks from the given file_id for each query, in query order.
+    All queries are embedded in one batch and searched with a single Chroma query.
+    Documents with at most k chunks are returned whole for every query, without embedding.
+    """
+    if not queries:
+        return []
+    try:
+        small = _small_file_chunks([file_id], k)
+        if file_id in small:
+            return [list(small[file_id]) for _ in queries]
+        query_vectors = embedding_function.embed_documents(queries)
+        entries = _flat_index_entries([file_id])
+        if entries:
+            return flat_index.search(entries[file_id], query_vectors, k)
+        return _query_chroma(query_vectors, [file_id], k)
+    except Exception as e:
+        print(f"Error retrieving chunks from Chroma: {e}")
+        return [[] for _ in queries]
+
+def get_relevant_chunks_across_files(query: str, file_ids: List[int], k: int = 6) -> Dict[int, List[Document]]:
+    """
+    Returns {file_id: top-k relevant chunks} for one query over many documents.
+    The query is embedded once and searched across all file_ids in a single Chroma query per shard;
+    files that the shared search left short of k chunks are backfilled with a per-file
+    search reusing the same query vector.
+    Documents with at most k chunks are fetched whole and take no part in the search.
+    """
+    grouped = {file_id: [] for file_id in file_ids}
+    if not file_ids:
+        return grouped
+    try:
+        small = _small_file_chunks(file_ids, k)
+        grouped.update(small)
+        large = [file_id for file_id in file_ids if file_id not in small]
+        if not large:
+            return grouped
+
+        query_vector = embedding_function.embed_query(query)
+        entries = _flat_index_entries(large)
+        if entries:
+            for file_id in large:
+                grouped[file_id] = flat_index.search(entries[file_id], [query_vector], k)[0]
+            return grouped
+
+        shared_docs = _query_chroma([query_vector], large, k * len(large))[0]
+        for doc in shared_docs:
+            file_id = doc.metadata.get("file_id")
+            if file_id in grouped and file_id not in small and len(grouped[file_id]) < k:
+                grouped[file_id].append(doc)
+
+        # A short result set means every matching chunk was already returned
+        if len(shared_docs) < k * len(large):
+            return grouped
+        for file_id in large:
+            if len(grouped[file_id]) < k:
+                grouped[file_id] = _query_chroma([query_vector], [file_id], k)[0]
+        return grouped
+    except Exception as e:
+        print(f"Error retrieving chunks from Chroma: {e}")
+        return grouped
@@ -1,6 +1,7 @@
 import requests
 import streamlit as st
 import os
+import json
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost/api").rstrip("/")
 
 
@@ -27,6 +28,35 @@ def get_api_response(question, session_id, model):
         st.error(f"An error occurred: {str(e)}")
         return None
 
+def stream_api_response(question, session_id, model):
+    """
+    Yields (event, data) pairs from the /chat/stream server-sent events as they arrive.
+    """
+    headers = {
+        'accept': 'text/event-stream',
+        'Content-Type': 'application/json'
+    }
+    data = {
+        "question": question,
+        "model": model
+    }
+    if session_id:
+        data["session_id"] = session_id
+
+    try:
+        with requests.post(f"{API_BASE_URL}/chat/stream", headers=headers, json=data, stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"API request failed with status code {response.status_code}: {response.text}")
+                return
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    yield event, json.loads(line[len("data: "):])
+    except Exception as e:
+        st.error(f"An error occurred: {str(e)}")
+
 def upload_document(file):
     print("Uploading file...")
     try:
@@ -41,6 +71,23 @@ def upload_document(file):
         st.error(f"An error occurred while uploading the file: {str(e)}")
         return None
 
+def upload_documents(files):
+    """
+    Upload many files in one request and yield the backend's NDJSON progress events as dicts.
+    """
+    print("Uploading files...")
+    try:
+        multipart = [("files", (file.name, file, file.type)) for file in files]
+        with requests.post(f"{API_BASE_URL}/upload-docs", files=multipart, stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"Failed to upload files. Error: {response.status_code} - {response.text}")
+                return
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+    except Exception as e:
+        st.error(f"An error occurred while uploading the files: {str(e)}")
+
 def list_documents():
     try:
         response = requests.get(f"{API_BASE_URL}/list-docs")
@@ -70,6 +117,24 @@ def delete_document(file_id):
     except Exception as e:
         st.error(f"An error occurred while deleting the document: {str(e)}")
         return None 
+
+def delete_documents(file_ids):
+    headers = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+    data = {"file_ids": file_ids}
+
+    try:
+        response = requests.post(f"{API_BASE_URL}/delete-docs", headers=headers, json=data)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            st.error(f"Failed to delete documents. Error: {response.status_code} - {response.text}")
+            return None
+    except Exception as e:
+        st.error(f"An error occurred while deleting the documents: {str(e)}")
+        return None
     
     
 def summarize_documents(file_ids):
@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import get_api_response
+from api_utils import stream_api_response
 
 
 
@@ -116,23 +116,41 @@ def display_chat_interface():
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        with st.spinner("Generating response..."):
-            response = get_api_response(prompt, st.session_state.session_id, model='gpt-4o-mini')
-            
-            
-            if response:
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            placeholder.markdown("_Generating response..._")
+
+            # Tokens are rendered as they arrive; "done" carries the final answer
+            answer = ""
+            response = {}
+            for event, data in stream_api_response(prompt, st.session_state.session_id, model='gpt-4o-mini'):
+                if event == "session":
+                    response.update(data)
+                elif event == "sources":
+                    response["sources"] = data
+                elif event == "token":
+                    answer += data["text"]
+                    placeholder.markdown(answer + "▌")
+                elif event == "done":
+                    response.update(data)
+                elif event == "error":
+                    st.error(f"Response failed: {data.get('detail')}")
+
+            if "answer" in response:
+                placeholder.markdown(response['answer'])
                 st.session_state.session_id = response.get('session_id')
                 st.session_state.messages.append({"role": "assistant", "content": response['answer']})
-                
-                with st.chat_message("assistant"):
-                    st.markdown(response['answer'])
-                    
-                    with st.expander("Details"):
-                        st.subheader("Sources Used")
-                        st.code(response['sources'])
-                        st.subheader("Model Used")
-                        st.code(response['model'])
-                        st.subheader("Session ID")
-                        st.code(response['session_id'])
+
+                with st.expander("Details"):
+                    st.subheader("Sources Used")
+                    st.code(response.get('sources', []))
+                    st.subheader("Model Used")
+                    st.code(response['model'])
+                    st.subheader("Session ID")
+                    st.code(response['session_id'])
+                    if response.get('cache'):
+                        st.subheader("Answer Cache")
+                        st.code(response['cache'])
             else:
+                placeholder.markdown(answer)
                 st.error("Failed to get a response from the API. Please try again.")
\ No newline at end of file
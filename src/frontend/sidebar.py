@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import upload_document, list_documents, delete_document ,summarize_documents
+from api_utils import upload_documents, list_documents, delete_documents ,summarize_documents
 
 def display_sidebar():
     st.sidebar.header("Upload Forms")
@@ -20,29 +20,36 @@ def display_sidebar():
         st.sidebar.write(f"Selected {len(uploaded_files)} file(s)")
 
         if st.sidebar.button("Upload All"):
-            with st.spinner("Uploading..."):
-                for uploaded_file in uploaded_files:
-                    existing_doc = next(
-                        (doc for doc in documents if doc["filename"] == uploaded_file.name),
-                        None
-                    )
-
-                    if existing_doc:
-                        st.sidebar.info(
-                            f"'{uploaded_file.name}' already uploaded. Using existing ID: {existing_doc['id']}"
-                        )
-                        continue
-
-                    upload_response = upload_document(uploaded_file)
-                    if upload_response:
-                        st.sidebar.success(
-                            f"Uploaded '{uploaded_file.name}' (ID: {upload_response['file_id']})"
-                        )
-                    else:
-                        st.sidebar.error(f"Failed to upload '{uploaded_file.name}'")
-
-                # Refresh list after all uploads
-                st.session_state.documents = list_documents()
+            progress_bar = st.sidebar.progress(0.0, text="Uploading...")
+            total = len(uploaded_files)
+            finished = 0
+
+            # One bulk request; the backend streams an event per file and stage
+            for event in upload_documents(uploaded_files):
+                name = event.get("filename")
+                if event["event"] == "duplicate":
+                    finished += 1
+                    st.sidebar.info(f"'{name}' already uploaded. Using existing ID: {event['file_id']}")
+                elif event["event"] == "rejected":
+                    finished += 1
+                    st.sidebar.error(f"Failed to upload '{name}': {event['message']}")
+                elif event["event"] == "completed":
+                    finished += 1
+                    st.sidebar.success(f"Uploaded '{name}' (ID: {event['file_id']})")
+                    if event.get("failed_pages"):
+                        st.sidebar.warning(f"'{name}': text could not be extracted from pages {event['failed_pages']}")
+                elif event["event"] == "failed":
+                    finished += 1
+                    st.sidebar.error(f"Failed to index '{name}': {event['error']}")
+                elif event["event"] == "progress":
+                    progress_bar.progress(finished / total, text=f"{name}: {event['stage']}")
+                    continue
+                else:
+                    continue
+                progress_bar.progress(finished / total, text=f"{finished}/{total} files processed")
+
+            # Refresh list after all uploads
+            st.session_state.documents = list_documents()
 
             st.rerun()
 
@@ -120,17 +127,17 @@ def display_sidebar():
         #         f"{doc['filename']} (ID: {doc['id']}, Uploaded: {doc['upload_timestamp']})"
         #     )
 
-        selected_file_id = st.sidebar.selectbox(
-            "Select a document to delete",
+        selected_file_ids = st.sidebar.multiselect(
+            "Select documents to delete",
             options=[doc["id"] for doc in documents],
             format_func=lambda x: next(doc["filename"] for doc in documents if doc["id"] == x)
         )
 
-        if st.sidebar.button("Delete Selected Document"):
+        if st.sidebar.button("Delete Selected Documents", disabled=not selected_file_ids):
             with st.spinner("Deleting..."):
-                delete_response = delete_document(selected_file_id)
+                delete_response = delete_documents(selected_file_ids)
                 if delete_response:
-                    st.sidebar.success(f"Document with ID {selected_file_id} deleted successfully.")
+                    st.sidebar.success(delete_response["message"])
                     st.session_state.documents = list_documents()
                 else:
-                    st.sidebar.error(f"Failed to delete document with ID {selected_file_id}.")
+                    st.sidebar.error(f"Failed to delete documents with IDs {selected_file_ids}.")